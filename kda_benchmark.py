@@ -0,0 +1,322 @@
+#! /opt/local/bin/python
+
+"""
+    KDA File Reader Benchmarks (Python)
+    
+    Writes synthetic KDA files of a given length and rate, times each
+    stage of kda_reader.py on them, and compares the results against a
+    stored baseline so that slower stages can be seen.
+    
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+"""
+
+#--- Import the necessary libraries for this file
+import json     # used for storing the baseline
+import multiprocessing # used for measuring the memory of each stage
+import numpy    # used for making the synthetic data
+import optparse # used for parsing options
+import os       # used for file operations
+import resource # used for measuring peak memory
+import shutil   # used for removing the synthetic files
+import StringIO # used for throwing away printed results
+import sys      # used for exiting program
+import tempfile # used for a directory to write the synthetic files in
+import time     # used for timing each stage
+
+import kda_reader
+
+#--- Default settings for the benchmarks
+SIZES = [1200, 12000, 120000] # Rows in each single file benchmark
+DIR_SIZES = [1, 8, 32]        # Files in each directory benchmark
+DIR_ROWS = 12000              # Rows in each file of a directory benchmark
+SCAN_RATE = 1200              # Hz
+REPEAT = 3                    # Times to run each stage, keeping the fastest
+TOLERANCE = 1.25              # Slowest time against the baseline before failing
+
+#--- A function to write a synthetic KDA file
+#    The body is a standing subject who dips, jumps off both plates, lands
+#    and settles, split unevenly between the plates, plus some sway and
+#    noise.  Raw readings are in mV so they are divided by the default
+#    calibration factors.
+def writeKDA(filename,            # Name of the file to write
+             rows,                # Number of records in the file
+             scan_rate = SCAN_RATE, # Hz
+             seed = 0,            # Seed for the noise
+             mass = 70.0,         # kg
+             header = 'GR1'):     # Test header code
+    
+    random = numpy.random.RandomState(seed)
+    t = numpy.arange(rows) / float(scan_rate)
+    duration = max(t[-1], 1.0/scan_rate)
+    
+    #--- Build the vertical force of the whole body through the jump
+    #    Units: N
+    weight = mass * kda_reader.GRAVITY
+    phase = t / duration
+    z = numpy.ones(rows) * weight
+    z -= 0.4*weight * numpy.exp(-((phase - 0.35)/0.04)**2) # dip
+    z += 1.2*weight * numpy.exp(-((phase - 0.45)/0.03)**2) # push off
+    z[(phase > 0.5) & (phase < 0.6)] = 0.0                # flight
+    z += 2.5*weight * numpy.exp(-((phase - 0.62)/0.015)**2) * (phase >= 0.6) # landing
+    
+    #--- Split the force between the plates and add sway and noise
+    data = random.normal(0, 0.002, (rows, kda_reader.NUM_COLUMNS))
+    for column, share in ((0, 0.55), (8, 0.45)):
+        plate_z = share * z
+        sway = 0.03 * plate_z * numpy.sin(2*numpy.pi*0.7*t + column)
+        data[:,column+0:column+2] += (sway / 2.0 / kda_reader.Xc1)[:,numpy.newaxis]
+        data[:,column+2:column+4] += (0.5*sway / 2.0 / kda_reader.Yc1)[:,numpy.newaxis]
+        data[:,column+4:column+8] += (plate_z / 4.0 / kda_reader.Zc1)[:,numpy.newaxis]
+    
+    #--- Write the header and the body
+    file = open(filename, 'wb')
+    file.write('%s Test\n' % header)
+    file.write('6/26/2010 -- 3:45 PM\n')
+    file.write('Scan Rate = %d\n' % scan_rate)
+    file.write('Total Scans = %d\n' % rows)
+    file.write('Digital Trigger Off\n')
+    file.write('X1,X2,Y1,Y2,Z1,Z2,Z3,Z4,X1,X2,Y1,Y2,Z1,Z2,Z3,Z4\n')
+    numpy.savetxt(file, data, fmt = '%.6f', delimiter = ',')
+    file.close()
+
+#--- A function to write a directory of synthetic KDA files
+#    The names follow the convention kda_reader.py looks for
+def writeDirectory(dirName,             # Directory to write in
+                   files,               # Number of files
+                   rows = DIR_ROWS,     # Number of records in each file
+                   scan_rate = SCAN_RATE): # Hz
+    file_list = []
+    for index in xrange(files):
+        filename = os.path.join(dirName, 'GR1_%03d.KDA' % index)
+        writeKDA(filename, rows, scan_rate, seed = index)
+        file_list.append(filename)
+    return file_list
+
+#--- Run a stage in its own process so its peak memory can be found
+#    Returns the fastest time in seconds and the memory it added in MB
+def measureStage(queue, stage, repeat):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    setup, run = stage
+    best = None
+    for count in xrange(repeat):
+        state = setup()
+        begin = time.time()
+        run(state)
+        elapsed = time.time() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((best, (peak_rss - start_rss) / 1024.0))
+
+def timeStage(stage, repeat = REPEAT):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target = measureStage, args = (queue, stage, repeat))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+#--- The stages for a single file
+#    Each stage is a (setup, run) pair, where setup is not timed
+def fileStages(filename, cache_dir, plot_dir):
+    
+    def nothing():
+        return None
+    
+    def loaded():
+        data = kda_reader.readKDA(filename)[-1]
+        header = kda_reader.readHeader(filename)[0]
+        matrix = kda_reader.fileCalibration(filename, header)[1]
+        return data, matrix
+    
+    def calibrated():
+        data, matrix = loaded()
+        return kda_reader.calibrate(data, matrix)
+    
+    def parsed():
+        return kda_reader.parseFile(filename)
+    
+    def draw(trial):
+        cwd = os.getcwd()
+        os.chdir(plot_dir)
+        try:
+            kda_reader.plot_plates(trial, plate_1 = True, plate_2 = True,
+                                   z_plot = True, headless = True)
+        finally:
+            os.chdir(cwd)
+    
+    def printed(trial):
+        out = StringIO.StringIO()
+        kda_reader.impulse(trial, out)
+        kda_reader.weight(trial, out)
+    
+    delta_t = 1.0 / kda_reader.readHeader(filename)[2]
+    kda_reader.parseFile(filename, cache_dir = cache_dir)
+    
+    return [('readHeader', (nothing, lambda state: kda_reader.readHeader(filename))),
+            ('readKDA', (nothing, lambda state: kda_reader.readKDA(filename))),
+            ('calibrate', (loaded, lambda state: kda_reader.calibrate(*state))),
+            ('trapz', (calibrated, lambda state: numpy.trapz(state, dx = delta_t, axis = -1))),
+            ('parseFile', (nothing, lambda state: kda_reader.parseFile(filename))),
+            ('parseFile cached', (nothing, lambda state: kda_reader.parseFile(filename, cache_dir = cache_dir))),
+            ('streamFile', (nothing, lambda state: kda_reader.streamFile(filename))),
+            ('impulse/weight', (parsed, printed)),
+            ('plot_plates', (parsed, draw))]
+
+#--- The stages for a directory of files
+def directoryStages(file_list, plot_dir):
+    
+    def nothing():
+        return None
+    
+    def parseAll(state = None):
+        tasks = [(kda_reader.parseFile, file, {}, True, None, False) for file in file_list]
+        return [kda_reader.processFile(task)[1] for task in tasks]
+    
+    def collection():
+        file_dict = {}
+        for trial in parseAll():
+            trial['align'] = float(trial.get('contact_frame') or 0)
+            file_dict[trial['filename']] = trial
+        return file_dict
+    
+    def draw(file_dict):
+        cwd = os.getcwd()
+        os.chdir(plot_dir)
+        try:
+            kda_reader.plot_collection(file_dict, plate_1 = True, plate_2 = True,
+                                       z_plot = True, headless = True)
+        finally:
+            os.chdir(cwd)
+    
+    return [('parse directory', (nothing, parseAll)),
+            ('batchSummary', (parseAll, kda_reader.batchSummary)),
+            ('plot_collection', (collection, draw))]
+
+#--- Print the results and compare them against the baseline
+#    Returns the number of stages that are slower than the tolerance
+def report(results,          # List of result dictionaries
+           baseline = None,  # Dictionary of results keyed by stage and size
+           tolerance = TOLERANCE):
+    
+    print "#%s%s%s%s%s%s%s" % (str('Stage'         ).rjust(19,' '),
+                              str('Files'         ).rjust(6,' '),
+                              str('Samples'       ).rjust(10,' '),
+                              str('Time (s)'      ).rjust(10,' '),
+                              str('Samples/s'     ).rjust(12,' '),
+                              str('Memory (MB)'   ).rjust(12,' '),
+                              str('Baseline'      ).rjust(10,' '))
+    slower = 0
+    for result in results:
+        compare = ''
+        if baseline is not None:
+            previous = baseline.get(resultKey(result))
+            if previous:
+                ratio = result['time'] / previous['time']
+                compare = '%.2fx' % ratio
+                if ratio > tolerance:
+                    compare += ' SLOWER'
+                    slower += 1
+        print "%s%s%s%s%s%s %s" % (str('%s'   % result['stage']     ).rjust(20,' '),
+                                   str('%d'   % result['files']     ).rjust(6,' '),
+                                   str('%d'   % result['samples']   ).rjust(10,' '),
+                                   str('%.4f' % result['time']      ).rjust(10,' '),
+                                   str('%.3g' % result['throughput']).rjust(12,' '),
+                                   str('%.1f' % result['memory']    ).rjust(12,' '),
+                                   compare.rjust(9,' '))
+    return slower
+
+def resultKey(result):
+    return '%s/%d/%d' % (result['stage'], result['files'], result['samples'])
+
+#--- Declare the program that will run
+if __name__ == '__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('--baseline', action='store', type='string', dest='baseline',
+                 help='Compare the results against this baseline file')
+    p.add_option('--dirs', action='store', type='string', dest='dirs',
+                 default = ','.join([str(size) for size in DIR_SIZES]),
+                 help='Comma separated numbers of files for the directory benchmarks')
+    p.add_option('--dir-rows', action='store', type='int', dest='dir_rows',
+                 default = DIR_ROWS, help='Number of records in each file of a directory')
+    p.add_option('--rate', action='store', type='int', dest='rate',
+                 default = SCAN_RATE, help='Scan rate of the synthetic files in Hz')
+    p.add_option('--repeat', action='store', type='int', dest='repeat',
+                 default = REPEAT, help='Number of times to run each stage, keeping the fastest')
+    p.add_option('--save-baseline', action='store', type='string', dest='save_baseline',
+                 help='Save the results as a baseline file')
+    p.add_option('--sizes', action='store', type='string', dest='sizes',
+                 default = ','.join([str(size) for size in SIZES]),
+                 help='Comma separated numbers of records for the single file benchmarks')
+    p.add_option('--tolerance', action='store', type='float', dest='tolerance',
+                 default = TOLERANCE, help='Slowest time against the baseline before failing')
+    p.add_option('--write', action='store', type='string', dest='write',
+                 help='Only write a synthetic file with --sizes records to this name')
+    
+    options,arguments = p.parse_args()
+    
+    try:
+        sizes = [int(size) for size in options.sizes.split(',') if size]
+        dir_sizes = [int(size) for size in options.dirs.split(',') if size]
+    except ValueError:
+        p.print_help()
+        sys.exit()
+    
+    #--- Only write a synthetic file if asked to
+    if options.write:
+        writeKDA(options.write, sizes[0], options.rate)
+        sys.exit()
+    
+    baseline = None
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+    
+    work_dir = tempfile.mkdtemp(prefix = 'kda_benchmark_')
+    cache_dir = os.path.join(work_dir, 'cache')
+    plot_dir = os.path.join(work_dir, 'plots')
+    os.mkdir(plot_dir)
+    results = []
+    try:
+        #--- Time each stage on a single file of each size
+        for index, size in enumerate(sizes):
+            filename = os.path.join(work_dir, 'GR1_%03d.KDA' % index)
+            writeKDA(filename, size, options.rate)
+            for stage, functions in fileStages(filename, cache_dir, plot_dir):
+                elapsed, memory = timeStage(functions, options.repeat)
+                results.append({'stage': stage, 'files': 1, 'samples': size,
+                                'time': elapsed, 'memory': memory,
+                                'throughput': size / max(elapsed, 1e-9)})
+            os.remove(filename)
+        
+        #--- Time the stages that work on a whole directory
+        for files in dir_sizes:
+            dirName = os.path.join(work_dir, 'dir_%d' % files)
+            os.mkdir(dirName)
+            file_list = writeDirectory(dirName, files, options.dir_rows, options.rate)
+            samples = files * options.dir_rows
+            for stage, functions in directoryStages(file_list, plot_dir):
+                elapsed, memory = timeStage(functions, options.repeat)
+                results.append({'stage': stage, 'files': files, 'samples': samples,
+                                'time': elapsed, 'memory': memory,
+                                'throughput': samples / max(elapsed, 1e-9)})
+            shutil.rmtree(dirName)
+    finally:
+        shutil.rmtree(work_dir)
+    
+    slower = report(results, baseline, options.tolerance)
+    
+    if options.save_baseline:
+        out = open(options.save_baseline, 'w')
+        json.dump(dict((resultKey(result), result) for result in results),
+                  out, indent = 1, sort_keys = True)
+        out.close()
+    
+    #--- Fail if any stage is slower than the baseline allows
+    if slower:
+        print "\n%d stages are slower than the baseline" % slower
+        sys.exit(1)
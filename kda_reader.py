@@ -24,13 +24,48 @@
 """
 
 #--- Import the necessary libraries for this file
+import ConfigParser # used for reading calibration profiles
+import collections # used for keeping the order of the results columns
+import cPickle  # used for storing the results of each file
+import cProfile # used for profiling a whole run
+import csv      # used for writing the results as a table
+import fnmatch  # used for finding files while indexing a directory
+import fractions # used for the ratio between two scan rates
 import glob     # used for loading files in a directory
+import hashlib  # used for keying and checking cached files
+import itertools # used for running the batch without a process pool
+import json     # used for storing cached header information
+import matplotlib.backends.backend_agg # used for drawing plots without a display
+import matplotlib.collections # used for drawing many lines at once
+import matplotlib.colors # used for drawing many lines at once
+import matplotlib.figure # used for drawing plots without a display
+import matplotlib.lines # used for the legend of many lines drawn at once
+import mmap     # used for counting the records in a file without reading it
+import multiprocessing # used for processing files in parallel
 import numpy    # used for loading text and the trapezoid rule
 import optparse # used for parsing options
 import os       # used for file operations
 import pylab    # used for plotting and math functions
 import re       # used for regular expression matching
+import shutil   # used for joining the parts of a results file
+import sqlite3  # used for the index of files in a directory
+import StringIO # used for capturing messages from worker processes
 import sys      # used for exiting program
+import time     # used for waiting on files that are being written
+import traceback # used for reporting errors from worker processes
+
+#--- SciPy is only needed for filtering the forces
+try:
+    import scipy.signal
+except ImportError:
+    scipy = None
+
+#--- The resource module is only there on Unix, where it is used for the
+#    peak memory of each stage
+try:
+    import resource
+except ImportError:
+    resource = None
 
 #--- List of file extensions
 FILE_EXT_LIST = ['*.KDA','*.kda']
@@ -51,48 +86,365 @@ Zc2 = 1027.7
 Zc3 = 1029.9
 Zc4 = 1039.0
 
+#--- Set up the position of the Z-axis load cells on each plate
+#    The cells sit at (+-CELL_X, +-CELL_Y) from the center of the plate,
+#    Z1 at (+X, +Y), Z2 at (-X, +Y), Z3 at (-X, -Y) and Z4 at (+X, -Y)
+#    Units: m
+CELL_X = 0.120
+CELL_Y = 0.200
+
 #--- Default settings
 GRAVITY = 9.8 # m/s/s
 
+#--- Default settings for filtering the forces
+FILTER_ORDER = 4 # Order of the Butterworth low-pass filter
+NOTCH_Q = 30.0   # Quality factor of the notch filter (center / bandwidth)
+
+#--- Ways that trials can be resampled to a common rate
+#    poly uses a polyphase filter (SciPy) and fft truncates or pads the
+#    spectrum of each trial (NumPy)
+RESAMPLE_METHODS = ['poly', 'fft']
+
+#--- Types the samples can be stored as
+#    float32 halves the memory used by the data and forces, while the
+#    impulse and weight are still summed in double precision (see README)
+DTYPES = ['float64', 'float32']
+
+#--- Default length of each segment of a power spectrum
+SPECTRUM_SEGMENT = 1.0 # s
+
+#--- Default settings for finding when a subject is on a plate
+#    Contact starts when the Z-axis force rises above CONTACT_ON and
+#    ends when it falls below CONTACT_OFF.  Contacts shorter than
+#    CONTACT_MIN are ignored.
+CONTACT_ON = 20.0  # N
+CONTACT_OFF = 10.0 # N
+CONTACT_MIN = 0.02 # s
+
+#--- Default Z-axis force below which the center of pressure is not found
+#    Frames with less force on a plate have NaN for its center of pressure
+COP_FORCE = 20.0 # N
+
+#--- Default number of rows to read at a time when streaming a file
+CHUNK_ROWS = 10000
+
+#--- Default settings for following files that are being written
+FOLLOW_INTERVAL = 0.05 # s between checks for new data
+FOLLOW_FPS = 4         # Most updates of the results and plot each second
+FOLLOW_WINDOW = 10.0   # s of the most recent data to plot
+
+#--- Default settings for the cache of parsed files
+#    A 5 minute capture at 1200 Hz is about 55 MB in the cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.kda_cache')
+CACHE_SIZE = 4096 # MB
+
+#--- Name of the store of results for each file, kept in the cache directory
+#    The store keeps at most STORE_ROWS results, dropping the least
+#    recently used.  Each result is a few kB.
+RESULTS_FILE = 'results.sqlite'
+STORE_ROWS = 100000
+
 #--- List of files to reverse
 REVERSE_LIST = ['HIT_009.KDA','GR1_094.KDA']
 
-#--- A function to do a continuous sigma edit
-def sigmaEdit(x,sigmaThresh = None):
-    if sigmaThresh <= sqrt(3):
+#--- Name of the file holding calibration profiles for a directory
+#    Each section of the file is a profile with the conversion factors
+#    (Xc1 ... Zc4), the load cell positions (cell_x, cell_y) and an
+#    optional "reverse" list of files.  Values not
+#    given in a section are taken from the [DEFAULT] section, and then
+#    from the settings above.  The "default" profile is used unless
+#    another is asked for or a section is named after the file's header.
+CALIBRATION_FILE = 'kda_calibration.cfg'
+
+#--- Stage timers for finding where the time goes in a run
+#    Each stage adds its wall clock time, the change in resident memory,
+#    the growth of the peak memory and the number of times it ran to a
+#    table of totals.  Time spent in a stage started inside another stage
+#    only counts for the inner stage.  While the timers are off stage()
+#    hands back a stage that does nothing, so the cost is a function call.
+class StageTimers(object):
+    
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.running = []
+    
+    def stage(self, name): # Name of the stage
+        if not self.enabled:
+            return NO_STAGE
+        return Stage(self, name)
+    
+    def reset(self):
+        """Hand back the totals so far and start new ones"""
+        totals = self.totals
+        self.totals = {}
+        return totals
+    
+    def add(self, name, elapsed, memory, peak):
+        total = self.totals.get(name)
+        if total is None:
+            total = self.totals[name] = {'calls': 0, 'time': 0.0, 'memory': 0.0, 'peak': 0.0}
+        total['calls'] += 1
+        total['time'] += elapsed
+        total['memory'] += memory
+        total['peak'] += peak
+
+class Stage(object):
+    
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+    
+    def __enter__(self):
+        self.inner = [0.0, 0.0, 0.0]
+        self.timers.running.append(self)
+        self.memory = residentMemory()
+        self.peak = peakMemory()
+        self.start = time.time()
+        return self
+    
+    def __exit__(self, *exc_info):
+        usage = [time.time() - self.start,
+                 residentMemory() - self.memory,
+                 peakMemory() - self.peak]
+        self.timers.running.pop()
+        if self.timers.running:
+            outer = self.timers.running[-1].inner
+            for index, value in enumerate(usage):
+                outer[index] += value
+        elapsed, memory, peak = [value - inner for value, inner in zip(usage, self.inner)]
+        self.timers.add(self.name, elapsed, memory, peak)
+        return False
+
+class NoStage(object):
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+NO_STAGE = NoStage()
+
+#--- The stage timers used by every function in this file
+timers = StageTimers()
+
+#--- Find the resident memory of this process in MB
+#    This is only known on systems with /proc
+def residentMemory():
+    try:
+        statm = open('/proc/self/statm')
+        pages = int(statm.read().split()[1])
+        statm.close()
+    except (IOError, IndexError, ValueError):
+        return 0.0
+    return pages * PAGE_SIZE / 1048576.0
+
+#--- Find the peak resident memory of this process in MB
+#    The peak is given in bytes on Mac OS X and in kB elsewhere
+def peakMemory():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+PAGE_SIZE = 4096
+if resource is not None:
+    PAGE_SIZE = resource.getpagesize()
+
+#--- Check that a sigma threshold can be used for a sigma edit
+def checkSigma(sigmaThresh):
+    if sigmaThresh is None or sigmaThresh <= numpy.sqrt(3):
         print 'Error in sigmaEdit'
         print 'Sigma Threshold must be greater than sqrt(3)'
         print 'Sigma Threshold given: %s' % sigmaThresh
+        sys.exit()
+
+#--- A function to do a continuous sigma edit
+#    Points further than sigmaThresh standard deviations from the mean
+#    are removed, and the stats are found again until no more points are
+#    removed.  Every row of x (for example each calibrated channel) is
+#    edited along the last axis at the same time.
+#
+#    Running sums of the points that are left are kept, so each pass only
+#    has to take away the points it removed instead of finding the stats
+#    from scratch.  Returns a masked array with the removed points masked.
+def sigmaEdit(x,                 # Array to edit along the last axis
+              sigmaThresh = None, # Number of standard deviations to keep
+              mask = None):      # Points to leave out from the start
+    checkSigma(sigmaThresh)
     
-    nPointsRemoved = 1
+    x = numpy.asarray(x, dtype=float)
+    keep = numpy.ones(x.shape, dtype=bool)
+    if mask is not None:
+        keep &= ~numpy.asarray(mask, dtype=bool)
     
+    #--- Shift each row by its mean so the sum of squares stays accurate
+    count = keep.sum(axis = -1)[...,numpy.newaxis].astype(float)
+    shift = (x*keep).sum(axis = -1)[...,numpy.newaxis] / numpy.maximum(count, 1)
+    y = numpy.where(keep, x - shift, 0.0)
+    
+    total = y.sum(axis = -1)[...,numpy.newaxis]
+    total_sq = (y*y).sum(axis = -1)[...,numpy.newaxis]
+    
+    nPointsRemoved = 1
     while nPointsRemoved > 0:
         # Get stats
+        n = numpy.maximum(count, 1)
+        mean = total / n
+        std = numpy.sqrt(numpy.maximum(total_sq / n - mean*mean, 0.0))
+        
         # UpperBound = mean + sigmaThresh*std
         # LowerBound = mean - sigmaThresh*std
         # Apply bounds and determine points removed
-        nPointsRemoved = 0
+        removed = keep & (numpy.abs(y - mean) > sigmaThresh*std)
+        nPointsRemoved = removed.sum()
+        
+        # Take the removed points out of the running sums
+        if nPointsRemoved > 0:
+            keep &= ~removed
+            dropped = numpy.where(removed, y, 0.0)
+            count -= removed.sum(axis = -1)[...,numpy.newaxis]
+            total -= dropped.sum(axis = -1)[...,numpy.newaxis]
+            total_sq -= (dropped*dropped).sum(axis = -1)[...,numpy.newaxis]
     
-    return x
+    return numpy.ma.masked_array(x, mask = ~keep)
 
-#--- A function to look at the file header
-def readHeader(filename): # Name of the file to read
+#--- A function to do a continuous sigma edit against the stats of a
+#    rolling window around each point, for signals whose level changes
+#    Each pass finds the window sums from cumulative sums, so it is O(n)
+#    no matter how large the window is.
+def sigmaEditRolling(x,                 # Array to edit along the last axis
+                     sigmaThresh = None, # Number of standard deviations to keep
+                     window = 1201,     # Number of points in each window
+                     mask = None):      # Points to leave out from the start
+    checkSigma(sigmaThresh)
     
-    #--- Set a number for the maximum size of the header in the file
-    max_header_lines = 10
+    x = numpy.asarray(x, dtype=float)
+    keep = numpy.ones(x.shape, dtype=bool)
+    if mask is not None:
+        keep &= ~numpy.asarray(mask, dtype=bool)
     
-    #--- Set up regular expressions to match contents of header
-    #    Regular expressions are nice ways of specifying exactly what you
-    #    are looking for in a line of text and pulling out the data you
-    #    want, in this case the values between the < and > characters
-    rexp_header = re.compile(r'(?P<header>[A-Z]{2}[0-9]{1})')
-    rexp_datetime = re.compile(r'(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})\s+[-]{2}\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2})\s+(?P<meridiem>[A-Z]{2})')
-    rexp_scanrate = re.compile(r'Scan Rate = (?P<scan_rate>[0-9]{1,4})')
-    rexp_totalscans = re.compile(r'Total Scans = (?P<total_scans>[0-9]{1,4})')
-    rexp_triggerstate = re.compile(r'Digital Trigger (?P<trigger_state>\w{2,3})')
+    #--- Find the ends of the window around each point
+    samples = x.shape[-1]
+    half = max(int(window) // 2, 1)
+    index = numpy.arange(samples)
+    lower = numpy.maximum(index - half, 0)
+    upper = numpy.minimum(index + half + 1, samples)
     
-    #--- Open the file in a read-only state
-    file = open(filename, 'r')
+    #--- Shift each row by its mean so the sum of squares stays accurate
+    count = keep.sum(axis = -1)[...,numpy.newaxis]
+    shift = (x*keep).sum(axis = -1)[...,numpy.newaxis] / numpy.maximum(count, 1)
+    y = x - shift
+    
+    def windowSum(values):
+        cumulative = numpy.zeros(values.shape[:-1] + (samples + 1,))
+        numpy.cumsum(values, axis = -1, out = cumulative[...,1:])
+        return cumulative[...,upper] - cumulative[...,lower]
+    
+    nPointsRemoved = 1
+    while nPointsRemoved > 0:
+        # Get stats for the window around each point
+        kept = numpy.where(keep, y, 0.0)
+        n = numpy.maximum(windowSum(keep.astype(float)), 1)
+        mean = windowSum(kept) / n
+        std = numpy.sqrt(numpy.maximum(windowSum(kept*kept) / n - mean*mean, 0.0))
+        
+        # Apply bounds and determine points removed
+        removed = keep & (numpy.abs(y - mean) > sigmaThresh*std)
+        nPointsRemoved = removed.sum()
+        keep &= ~removed
+    
+    return numpy.ma.masked_array(x, mask = ~keep)
+
+#--- A function to find the average force on each plate for the weight
+#    The Z-axis forces are sigma edited first if a threshold is given
+#    Returns the weight on each plate
+#    Units: N
+def plateWeight(forces,         # Calibrated forces, rows in CHANNELS order
+                sigma = None,   # Sigma threshold for the edit
+                sigma_window = None, # Rolling window for the edit
+                mask = None):   # Points to leave out
+    z = forces[...,[2,5],:]
+    if sigma is None:
+        if mask is None:
+            return z.mean(axis = -1, dtype = numpy.float64)
+        z = numpy.ma.masked_array(z, mask = mask)
+    elif sigma_window:
+        z = sigmaEditRolling(z, sigma, sigma_window, mask = mask)
+    else:
+        z = sigmaEdit(z, sigma, mask = mask)
+    return z.mean(axis = -1, dtype = numpy.float64).filled(0.0)
+
+#--- Number of header rows at the top of a KDA file before the csv data
+HEADER_ROWS = 6
+
+#--- Number of data columns in a KDA file (8 channels on each of 2 plates)
+NUM_COLUMNS = 16
+
+#--- Names of the calibrated force channels, in the order they are stored
+CHANNELS = ['p1_X','p1_Y','p1_Z','p2_X','p2_Y','p2_Z']
+
+#--- Names of the center of pressure channels, in the order they are stored
+#    Units: m
+COP_CHANNELS = ['p1_COP_X','p1_COP_Y','p2_COP_X','p2_COP_Y']
+
+#--- Columns of the results table written for each file
+#    The width of the file name is set when the table is made
+SUMMARY_FIELDS = [('filename', 'S256'),
+                  ('header', 'S8'),
+                  ('timestamp', 'S20'),
+                  ('scan_rate', 'i8'),
+                  ('total_scans', 'i8'),
+                  ('trigger_state', 'S8'),
+                  ('total_time', 'f8')]
+SUMMARY_FIELDS += [('%s_imp_net' % channel, 'f8') for channel in CHANNELS]
+SUMMARY_FIELDS += [('p1_weight', 'f8'), ('p2_weight', 'f8')]
+
+#--- Columns of the results table for the center of pressure
+#    These are left out when streaming, which does not find it
+COP_FIELDS = [('%s_mean' % channel, 'f8') for channel in COP_CHANNELS]
+SUMMARY_FIELDS += COP_FIELDS
+
+#--- Name of the index of files kept in the top directory of the data
+INDEX_FILE = '.kda_index.sqlite'
+
+#--- Columns of the index that files can be selected by
+INDEX_FIELDS = ['filename', 'title', 'header', 'timestamp', 'scan_rate',
+                'total_scans', 'trigger_state', 'size', 'mtime']
+
+#--- Formats the results table can be written in
+#    Text is the fixed width table that is printed by default
+SUMMARY_FORMATS = ['text', 'csv', 'json', 'npy']
+
+#--- Number of rows to collect before writing them to the results file
+SUMMARY_ROWS = 1000
+
+#--- Set up regular expressions to match contents of header
+#    Regular expressions are nice ways of specifying exactly what you
+#    are looking for in a line of text and pulling out the data you
+#    want, in this case the values between the < and > characters
+#    These are compiled once here instead of every time a file is read
+rexp_header = re.compile(r'(?P<header>[A-Z]{2}[0-9]{1})')
+rexp_datetime = re.compile(r'(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})\s+[-]{2}\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2})\s+(?P<meridiem>[A-Z]{2})')
+rexp_scanrate = re.compile(r'Scan Rate = (?P<scan_rate>[0-9]+)')
+rexp_totalscans = re.compile(r'Total Scans = (?P<total_scans>[0-9]+)')
+rexp_triggerstate = re.compile(r'Digital Trigger (?P<trigger_state>\w{2,3})')
+
+#--- Set up a regular expression for the file name
+#    (ie three letters and number, an underscore, three numbers, file ext)
+#    Example: GR1_020.KDA 
+rexp_filename = re.compile(r'(?P<filename>[A-Z0-9]{3}_[0-9]{3})\.[KDA|kda]')
+
+#--- Set up a regular expression for a blank line in the data
+#    It matches the line break before a line that is empty or only has
+#    whitespace, so each blank line is matched once
+rexp_blankline = re.compile(r'\n[ \t\r]*(?=\n)')
+
+#--- A function to pull the header information out of a set of lines
+def parseHeaderLines(lines): # The lines at the top of the file
     
     #--- Set the following default variables
     header = 'GRF'
@@ -102,8 +454,7 @@ def readHeader(filename): # Name of the file to read
     trigger_state = 'Off'
     
     #--- Read the header information from the file by looking at each line
-    count = 0
-    for line in file:
+    for line in lines:
         #--- Get the test header
         rmatch_header = rexp_header.match(line)
         if rmatch_header:
@@ -139,58 +490,542 @@ def readHeader(filename): # Name of the file to read
         rmatch_triggerstate = rexp_triggerstate.match(line)
         if rmatch_triggerstate:
             trigger_state = rmatch_triggerstate.group('trigger_state')
-        
-        #--- Increment the counter until the max number of header lines
-        #    has been read.  Then exit the loop.
-        count += 1
-        if count > max_header_lines:
-            break
     
     #--- Return the important information
     return header, timestamp, scan_rate, total_scans, trigger_state
 
-def parseFile(filename,             # Name of the file to parse
-              range = (-1, -1)):    # Frame range
+#--- A function to look at the file header
+def readHeader(filename): # Name of the file to read
     
-    #--- We will save the data to a dictionary
-    data_dict = {}
+    #--- Set a number for the maximum size of the header in the file
+    max_header_lines = 10
     
-    #--- Read the header using another function
-    #    This returns useful information to verify the file and name it
-    header, timestamp, scan_rate, total_scans, trigger_state = readHeader(filename)
-    data_dict['filename'] = filename
-    data_dict['header'] = header
-    data_dict['timestamp'] = timestamp
-    data_dict['scan_rate'] = scan_rate
-    data_dict['total_scans'] = total_scans
-    data_dict['trigger_state'] = trigger_state
+    #--- Open the file in a read-only state
+    file = open(filename, 'r')
+    
+    #--- Collect lines until the max number of header lines has been read
+    lines = []
+    for line in file:
+        lines.append(line)
+        if len(lines) > max_header_lines:
+            break
+    file.close()
+    
+    #--- Return the important information
+    return parseHeaderLines(lines)
+
+#--- A function to decode a block of csv rows into a flat array of values
+#    Blank lines and carriage returns are dropped, then every line break
+#    becomes a comma so numpy can decode the whole block in one call
+def decodeRows(block):
+    block = block.replace('\r', '')
+    while '\n\n' in block:
+        block = block.replace('\n\n', '\n')
+    block = block.strip('\n')
+    if not block:
+        return 0, numpy.empty(0)
+    rows = block.count('\n') + 1
+    return rows, numpy.fromstring(block.replace('\n', ','), sep=',')
+
+#--- A function to read the header and the data in a single pass
+#    This is much faster than numpy.loadtxt, which parses each row in Python
+def readKDA(filename,              # Name of the file to read
+            block_size = 1 << 20,  # Bytes of csv data to decode at once
+            dtype = numpy.float64): # Type to store the samples as
+    
+    #--- Open the file in a read-only state and read the header rows
+    #    The file is closed even if the header or the data is bad
+    file = open(filename, 'rb')
+    try:
+        with timers.stage('header'):
+            lines = [file.readline() for i in xrange(HEADER_ROWS)]
+            header, timestamp, scan_rate, total_scans, trigger_state = parseHeaderLines(lines)
+        
+        with timers.stage('read'):
+            data = readRows(file, filename, total_scans, block_size, dtype)
+    finally:
+        file.close()
+    return header, timestamp, scan_rate, total_scans, trigger_state, data
+
+#--- Read the csv data after the header into an array
+def readRows(file,        # File open after the header rows
+             filename,    # Name of the file, for reading it with numpy
+             total_scans, # Number of records given in the header
+             block_size,  # Bytes of csv data to decode at once
+             dtype = numpy.float64): # Type to store the samples as
+    
+    #--- Preallocate the data using the number of scans in the header
+    #    Any extra rows are kept and joined at the end so that the
+    #    record count can still be checked against the header
+    data = numpy.empty(total_scans*NUM_COLUMNS, dtype=dtype)
+    filled = 0
+    extra = []
+    rows = 0
+    values = 0
+    
+    #--- Decode the csv data a block at a time, carrying the partial
+    #    line at the end of each block over to the next block
+    remainder = ''
+    while True:
+        block = file.read(block_size)
+        if not block:
+            block = remainder
+            remainder = ''
+        else:
+            block = remainder + block
+            cut = block.rfind('\n') + 1
+            block, remainder = block[:cut], block[cut:]
+        if not block:
+            if not remainder:
+                break
+            continue
+        
+        block_rows, block_values = decodeRows(block)
+        rows += block_rows
+        values += len(block_values)
+        
+        #--- Fill the preallocated array, saving anything that overflows
+        count = min(len(block_values), len(data) - filled)
+        data[filled:filled+count] = block_values[:count]
+        filled += count
+        if count < len(block_values):
+            extra.append(block_values[count:].astype(dtype))
+    
+    #--- Fall back on numpy if any row could not be decoded cleanly
+    if values != rows*NUM_COLUMNS:
+        return numpy.loadtxt(filename, skiprows=HEADER_ROWS, delimiter=',', dtype=dtype)
+    
+    if extra:
+        data = numpy.concatenate([data[:filled]] + extra)
+    return data[:values].reshape(rows, NUM_COLUMNS)
+
+#--- A function to count the records in a file without decoding them
+#    The file is memory mapped, the header is read and the line breaks
+#    after it are counted, ignoring any whitespace at the end of the file.
+#    Blank lines are not records, the same as when the data is decoded.
+#    Returns the header information and the number of records.
+def countRecords(filename,              # Name of the file to count
+                 block_size = 1 << 24): # Bytes to count at once
+    
+    file = open(filename, 'rb')
+    try:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            raise ValueError("%s is empty" % filename)
+        data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        file.close()
+    
+    try:
+        #--- Find the end of the header rows
+        start = 0
+        for i in xrange(HEADER_ROWS):
+            start = data.find('\n', start) + 1
+            if not start:
+                raise ValueError("The header of %s is not complete" % filename)
+        header, timestamp, scan_rate, total_scans, trigger_state = \
+            parseHeaderLines(data[:start].splitlines(True))
+        
+        #--- Count the line breaks up to the last record
+        end = size
+        while end > start and data[end-1] in ' \t\r\n':
+            end -= 1
+        #    Each block ends after a line break and takes in the line break
+        #    before it, so a blank line is never split between two blocks
+        records = 0
+        if end > start:
+            records = 1
+            block_start = start
+            while block_start < end:
+                block_end = min(block_start + block_size, end)
+                if block_end < end:
+                    cut = data.rfind('\n', block_start, block_end)
+                    if cut >= block_start:
+                        block_end = cut + 1
+                block = data[block_start-1:block_end]
+                records += block.count('\n') - 1 - len(rexp_blankline.findall(block))
+                block_start = block_end
+    finally:
+        data.close()
+    
+    return header, timestamp, scan_rate, total_scans, trigger_state, records
+
+#--- A function to compute a hash of the contents of a file
+def fileHash(filename,              # Name of the file to hash
+             block_size = 1 << 20): # Bytes to read at once
+    sha = hashlib.sha1()
+    file = open(filename, 'rb')
+    block = file.read(block_size)
+    while block:
+        sha.update(block)
+        block = file.read(block_size)
+    file.close()
+    return sha.hexdigest()
+
+#--- A function to find the sidecar files for a file in the cache
+#    The cache is keyed by the absolute path of the file so that files
+#    with the same name in different directories do not collide
+def cachePaths(filename, cache_dir):
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    base = os.path.join(cache_dir, key)
+    return base + '.npy', base + '.json'
+
+#--- A function to find the cached cumulative impulse for a trial
+#    The key includes everything the impulse depends on, so a stale copy
+#    is never found and is left for the eviction policy to remove
+def cumulativePath(filename,    # Name of the file the trial came from
+                   cache_dir,   # Directory holding the cache
+                   matrix,      # Calibration matrix used for the trial
+                   start_frame, # First frame of the trial
+                   frames,      # Number of frames in the trial
+                   sos = None,  # Filter sections used for the trial, if any
+                   dtype = numpy.float64): # Type the forces were stored as
+    stat = os.stat(filename)
+    sha = hashlib.sha1(os.path.abspath(filename))
+    sha.update('%r %r %d %d' % (stat.st_size, stat.st_mtime, start_frame, frames))
+    sha.update(numpy.ascontiguousarray(matrix).tostring())
+    if sos is not None:
+        sha.update(numpy.ascontiguousarray(sos).tostring())
+    if numpy.dtype(dtype) != numpy.float64:
+        sha.update(numpy.dtype(dtype).str)
+    return os.path.join(cache_dir, sha.hexdigest() + '.cum.npy')
+
+#--- A function to load a file from the cache
+#    Returns None if the file is not in the cache or the cached copy is stale
+def readCache(filename,            # Name of the file to look up
+              cache_dir = CACHE_DIR, # Directory holding the cache
+              use_hash = False):   # Also compare a hash of the contents
+    
+    data_path, meta_path = cachePaths(filename, cache_dir)
+    if not os.path.isfile(data_path) or not os.path.isfile(meta_path):
+        return None
+    
+    #--- Compare the cached key against the file as it is now
+    try:
+        meta_file = open(meta_path, 'r')
+        meta = json.load(meta_file)
+        meta_file.close()
+    except (IOError, ValueError):
+        return None
+    stat = os.stat(filename)
+    if meta.get('path') != os.path.abspath(filename) or \
+       meta.get('size') != stat.st_size or \
+       meta.get('mtime') != stat.st_mtime:
+        return None
+    if use_hash and meta.get('hash') != fileHash(filename):
+        return None
+    
+    #--- Memory-map the data rather than reading it all in
+    try:
+        data = numpy.load(data_path, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    
+    #--- Mark the entry as recently used for the eviction policy
+    try:
+        os.utime(data_path, None)
+    except OSError:
+        pass
+    
+    return (meta['header'], meta['timestamp'], meta['scan_rate'],
+            meta['total_scans'], meta['trigger_state'], data)
+
+#--- Time this run started, for telling which cache entries it has used
+#    Every entry that is read or written is touched, so an entry used by
+#    this run (in any process) has a modification time after this.
+cache_run_start = time.time()
+
+#--- Size in bytes of each cache directory as this process last saw it,
+#    and the directories that are full of entries used by this run
+cache_sizes = {}
+full_caches = set()
+
+#--- A function to remove the least recently used files from the cache
+#    until the cache is no larger than the given size
+#    Entries used since the given time are never removed, so a batch does
+#    not evict the entries it is about to use.
+#    Returns the size of the cache left in bytes.
+def pruneCache(cache_dir = CACHE_DIR, # Directory holding the cache
+               cache_size = CACHE_SIZE, # Maximum size in MB
+               since = None):         # Keep entries used since this time
+    
+    #--- Gather the entries with their last use and total size
+    entries = []
+    total = 0
+    for data_path in glob.glob(os.path.join(cache_dir, '*.npy')):
+        meta_path = data_path[:-len('.npy')] + '.json'
+        try:
+            size = os.path.getsize(data_path)
+            if os.path.isfile(meta_path):
+                size += os.path.getsize(meta_path)
+            entries.append((os.path.getmtime(data_path), size, data_path, meta_path))
+        except OSError:
+            continue
+        total += size
+    
+    #--- Remove the oldest entries first
+    entries.sort()
+    max_bytes = cache_size * 1024 * 1024
+    for mtime, size, data_path, meta_path in entries:
+        if total <= max_bytes or (since is not None and mtime >= since):
+            break
+        for path in (meta_path, data_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+    
+    cache_sizes[cache_dir] = total
+    return total
+
+#--- A function to make room in the cache for a new entry
+#    The size of the cache is kept as entries are written, so the cache
+#    directory is only scanned when it first looks full.  Only entries not
+#    used by this run are removed.  If the entries of this run alone fill
+#    the cache, nothing more is cached rather than evicting them.
+#    Returns True if the entry should be written.
+def cacheRoom(cache_dir,  # Directory holding the cache
+              cache_size, # Maximum size in MB
+              nbytes):    # Size of the new entry in bytes
+    
+    max_bytes = cache_size * 1024 * 1024
+    if cache_dir in full_caches or nbytes > max_bytes:
+        return False
+    if cache_dir not in cache_sizes or cache_sizes[cache_dir] + nbytes > max_bytes:
+        pruneCache(cache_dir, cache_size - nbytes / (1024.0 * 1024.0), since = cache_run_start)
+    if cache_sizes[cache_dir] + nbytes > max_bytes:
+        full_caches.add(cache_dir)
+        print >> sys.stderr, "The cache in %s is full, not caching any more files" % (cache_dir)
+        return False
+    cache_sizes[cache_dir] += nbytes
+    return True
+
+#--- A function to save an array in the cache
+#    The array is written to a temporary file and renamed so that a
+#    reader never sees a partially written file
+def saveArray(path,  # Name of the file to write
+              array): # The array to save
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    array_file = open(tmp_path, 'wb')
+    numpy.save(array_file, numpy.ascontiguousarray(array))
+    array_file.close()
+    os.rename(tmp_path, path)
+
+#--- A function to write a file's header and data to the cache
+def writeCache(filename,              # Name of the file that was read
+               result,                # The values returned by readKDA
+               cache_dir = CACHE_DIR, # Directory holding the cache
+               cache_size = CACHE_SIZE, # Maximum size in MB
+               use_hash = False):     # Also store a hash of the contents
+    
+    header, timestamp, scan_rate, total_scans, trigger_state, data = result
+    
+    #--- Do not let a bad cache directory stop the file from being used
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        
+        stat = os.stat(filename)
+        meta = {'path': os.path.abspath(filename),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'header': header,
+                'timestamp': timestamp,
+                'scan_rate': scan_rate,
+                'total_scans': total_scans,
+                'trigger_state': trigger_state}
+        if use_hash:
+            meta['hash'] = fileHash(filename)
+        
+        #--- Leave the file out of the cache if there is no room for it
+        if not cacheRoom(cache_dir, cache_size, data.nbytes):
+            return
+        
+        #--- Write to temporary files and rename them so that a reader
+        #    never sees a partially written entry
+        data_path, meta_path = cachePaths(filename, cache_dir)
+        saveArray(data_path, data)
+        tmp_meta = '%s.%d.tmp' % (meta_path, os.getpid())
+        meta_file = open(tmp_meta, 'w')
+        json.dump(meta, meta_file)
+        meta_file.close()
+        os.rename(tmp_meta, meta_path)
+    except (IOError, OSError), error:
+        print >> sys.stderr, "Unable to cache %s: %s" % (filename, error)
+
+#--- A function to read a file through the cache
+#    If no cache directory is given the file is always read from disk.
+#    The cache always holds double precision data, whatever the dtype.
+def loadKDA(filename,                # Name of the file to read
+            cache_dir = None,        # Directory holding the cache
+            rebuild_cache = False,   # Ignore and replace any cached copy
+            cache_size = CACHE_SIZE, # Maximum size of the cache in MB
+            cache_hash = False,      # Check a hash of the contents too
+            dtype = numpy.float64):  # Type to read the samples as
+    
+    if cache_dir is None:
+        return readKDA(filename, dtype = dtype)
+    
+    if not rebuild_cache:
+        with timers.stage('cache read'):
+            result = readCache(filename, cache_dir, use_hash = cache_hash)
+        if result is not None:
+            return result
+    
+    result = readKDA(filename)
+    with timers.stage('cache write'):
+        writeCache(filename, result, cache_dir, cache_size, use_hash = cache_hash)
+    return result
+
+#--- Open the index of files for a directory, making it if needed
+#    The index keeps the header information of each file along with its
+#    size and modification time, so that only new and changed files need
+#    to be read again.  Paths are kept relative to the directory.
+def openIndex(index_file): # Name of the index file
+    
+    connection = sqlite3.connect(index_file)
+    connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                              filename TEXT PRIMARY KEY,
+                              title TEXT,
+                              header TEXT,
+                              timestamp TEXT,
+                              scan_rate INTEGER,
+                              total_scans INTEGER,
+                              trigger_state TEXT,
+                              size INTEGER,
+                              mtime REAL)""")
+    return connection
+
+#--- Bring the index up to date with the files under a directory
+#    Python 2 has no os.scandir, so the tree is walked with os.walk and
+#    each file is only stat'ed.  Returns the number of files read again
+#    and the number removed from the index.
+def updateIndex(connection, # Open index from openIndex
+                dirName):   # Top directory of the data
+    
+    indexed = {}
+    for filename, size, mtime in connection.execute("SELECT filename, size, mtime FROM files"):
+        indexed[filename] = (size, mtime)
+    
+    found = set()
+    changed = []
+    for root, dirs, files in os.walk(dirName):
+        dirs.sort()
+        for name in files:
+            if not any([fnmatch.fnmatch(name, ext) for ext in FILE_EXT_LIST]):
+                continue
+            if not rexp_filename.match(name):
+                continue
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, dirName)
+            stat = os.stat(path)
+            found.add(filename)
+            if indexed.get(filename) == (stat.st_size, stat.st_mtime):
+                continue
+            
+            #--- Only the header of a new or changed file is read
+            header, timestamp, scan_rate, total_scans, trigger_state = readHeader(path)
+            title = name.split('.')[0]
+            changed.append((filename, title, header, timestamp, scan_rate, total_scans,
+                            trigger_state, stat.st_size, stat.st_mtime))
+    
+    removed = [(filename,) for filename in indexed if filename not in found]
+    connection.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?)", changed)
+    connection.executemany("DELETE FROM files WHERE filename = ?", removed)
+    connection.commit()
+    return len(changed), len(removed)
+
+#--- Find the files in the index that match every selection
+#    Each selection is "FIELD=VALUE", where the value may use the * and ?
+#    wildcards, or "FIELD<VALUE", "FIELD>VALUE" and so on for numbers and
+#    timestamps.  Returns the paths of the files, sorted.
+def selectFiles(connection,        # Open index from openIndex
+                dirName,           # Top directory of the data
+                selections = None): # List of selections
+    
+    rexp_selection = re.compile(r'^(?P<field>\w+)\s*(?P<op><=|>=|!=|=|<|>)\s*(?P<value>.*)$')
+    
+    clauses = []
+    values = []
+    for selection in selections or []:
+        rmatch_selection = rexp_selection.match(selection)
+        if not rmatch_selection or rmatch_selection.group('field') not in INDEX_FIELDS:
+            print "\nUnable to select files with: %s" % (selection)
+            print "\tSelections look like FIELD=VALUE, where FIELD is one of:"
+            print "\t%s" % (', '.join(INDEX_FIELDS))
+            sys.exit()
+        field, op, value = rmatch_selection.group('field', 'op', 'value')
+        if op == '=' and ('*' in value or '?' in value):
+            op = 'GLOB'
+        clauses.append('%s %s ?' % (field, op))
+        values.append(value)
+    
+    query = "SELECT filename FROM files"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    return sorted([os.path.join(dirName, filename)
+                   for filename, in connection.execute(query, values)])
+
+#--- A function to find the files to use from the index of a directory
+def indexedFiles(dirName,            # Top directory of the data
+                 selections = None,  # List of selections for selectFiles
+                 index_file = None): # Name of the index, if not in dirName
+    
+    if index_file is None:
+        index_file = os.path.join(dirName, INDEX_FILE)
+    connection = openIndex(index_file)
+    try:
+        updateIndex(connection, dirName)
+        return selectFiles(connection, dirName, selections)
+    finally:
+        connection.close()
+
+#--- A function to put the header information for a file in a dictionary
+def fileInfo(filename, header, timestamp, scan_rate, total_scans, trigger_state):
+    
+    info = {}
+    info['filename'] = filename
+    info['header'] = header
+    info['timestamp'] = timestamp
+    info['scan_rate'] = scan_rate
+    info['total_scans'] = total_scans
+    info['trigger_state'] = trigger_state
     
     #--- Create a test name identifier for naming and saving plots
     #    The convention used here is "FILENAME_TIMESTAMP"
     title = os.path.basename(filename).split('.')[0]
-    data_dict['title'] = title
+    info['title'] = title
     identifier = '%s_%s' % (title,timestamp)
-    data_dict['identifier'] = identifier
+    info['identifier'] = identifier
     
-    #--- Load the data from the file name that was given
-    #    Skip the first six rows of header data
-    #    Use a comma as the delimiter
-    data = numpy.loadtxt(filename, skiprows=6, delimiter=',')
+    #--- Set the frequency and find the time delta between frames
+    freq = scan_rate   # Hz
+    delta_t = 1.0/freq # s
+    info['delta_t'] = delta_t
     
-    #--- Do some internal checking on the data
-    #    compare the data length against the file's header information
-    if len(data) != total_scans:
+    return info
+
+#--- Compare the data length against the file's header information
+def checkRecords(found,       # Number of records found in the file
+                 total_scans): # Number of records given in the header
+    if found != total_scans:
         print "\nA problem exists with your file:"
         print "\tNumber of records expected: %d" % (total_scans)
-        print "\tNumber of records found: %d" % (len(data))
+        print "\tNumber of records found: %d" % (found)
         print "\tCheck that file is not missing data or corrupted"
         print "\tThe easiest fix is to adjust the header if everything looks ok"
         sys.exit()
+
+#--- Determine the range of frames to use from the file
+#    Returns the start frame and the frame after the last one to use
+def frameRange(range,  # Frame range given by the user
+               found): # Number of records in the file
     
     #--- Set Frame Defaults to encompass all the data
     start_frame = 0
-    end_frame = len(data)-1
-
+    end_frame = found
+    
     #--- Determine the range of the data to use for the plot
     #    Do nothing if either frame value is set to the default
     if range[0] != -1 and range[1] != -1:
@@ -202,9 +1037,9 @@ def parseFile(filename,             # Name of the file to parse
             start_frame = int(range[0])
         
         #--- Ensure end_frame not outside data boundary
-        if int(range[1]) >= len(data):
+        if int(range[1]) >= found:
             print "\nYou cannot specify an ending frame larger than the data set"
-            print "\tNumber of records found: %d" % (len(data))
+            print "\tNumber of records found: %d" % (found)
             print "\tGiven End Frame: %s" % (range[1]) 
             sys.exit()
         else:
@@ -216,94 +1051,557 @@ def parseFile(filename,             # Name of the file to parse
             print "\tGiven Start Frame: %s" % (start_frame)
             print "\tGiven End Frame: %s" % (end_frame)
             sys.exit()
-        
-        #--- Slice the data to the desired size
-        data = data[start_frame:end_frame]
+    
+    return start_frame, end_frame
+
+#--- Names of the conversion factors in a calibration profile
+FACTOR_NAMES = ['Xc1','Xc2','Yc1','Yc2','Zc1','Zc2','Zc3','Zc4']
+
+#--- Names of the load cell positions in a calibration profile
+GEOMETRY_NAMES = ['cell_x','cell_y']
+
+#--- The calibration profile made from the settings at the top of the file
+def defaultProfile():
+    return {'Xc1': Xc1, 'Xc2': Xc2,
+            'Yc1': Yc1, 'Yc2': Yc2,
+            'Zc1': Zc1, 'Zc2': Zc2, 'Zc3': Zc3, 'Zc4': Zc4,
+            'cell_x': CELL_X, 'cell_y': CELL_Y,
+            'reverse': list(REVERSE_LIST)}
 
-    #--- Now put the GRF data for each column into a variable
-    #    p1_ and p2_ are prefixes for plates 1 and 2 respectively
+#--- Calibration files that have already been read, by name
+calibration_files = {}
+
+#--- A function to read the calibration profiles from a file
+#    Returns a dictionary of profiles by name
+def readCalibration(calibration_file): # Name of the file to read
+    
+    #--- Only read each file once unless it changes
+    mtime = os.path.getmtime(calibration_file)
+    if calibration_file in calibration_files:
+        if calibration_files[calibration_file][0] == mtime:
+            return calibration_files[calibration_file][1]
+    
+    config = ConfigParser.SafeConfigParser()
+    config.optionxform = str # Keep the case of the factor names
+    config.read(calibration_file)
+    
+    profiles = {}
+    for section in config.sections():
+        profile = defaultProfile()
+        for name in FACTOR_NAMES + GEOMETRY_NAMES:
+            if config.has_option(section, name):
+                profile[name] = config.getfloat(section, name)
+        if config.has_option(section, 'reverse'):
+            reverse = config.get(section, 'reverse').replace(',', ' ')
+            profile['reverse'] = reverse.split()
+        profiles[section] = profile
+    
+    calibration_files[calibration_file] = (mtime, profiles)
+    return profiles
+
+#--- A function to pick the calibration profile for a file
+#    Returns the name of the profile and the profile
+def findProfile(filename,                # Name of the file being read
+                header,                  # Header code read from the file
+                calibration_file = None, # File of calibration profiles
+                profile = None):         # Name of the profile to use
+    
+    #--- Look for a calibration file in the same directory as the file
+    if calibration_file is None:
+        calibration_file = os.path.join(os.path.dirname(filename), CALIBRATION_FILE)
+        if not os.path.isfile(calibration_file):
+            calibration_file = None
+    
+    profiles = {}
+    if calibration_file is not None:
+        profiles = readCalibration(calibration_file)
+    
+    #--- A profile that was asked for by name must exist
+    if profile is not None:
+        if profile not in profiles:
+            print "\nThe calibration profile '%s' could not be found" % (profile)
+            print "\tCalibration file: %s" % (calibration_file)
+            sys.exit()
+        return profile, profiles[profile]
+    
+    #--- Otherwise use the profile for the header, then the default
+    for name in (header, 'default'):
+        if name in profiles:
+            return name, profiles[name]
+    return 'default', defaultProfile()
+
+#--- Calibration matrices that have already been built
+calibration_matrices = {}
+
+#--- A function to build the calibration matrix for a profile
+#    The matrix has a row for each raw column and a column for each of
+#    the channels in CHANNELS, followed by a column for each channel in
+#    COP_CHANNELS, so the forces and the moments of the Z-axis load
+#    cells about the center of each plate are one matrix product
+#    Units: N/mV and N*m/mV
+def calibrationMatrix(profile,         # The calibration profile
+                      reverse = False): # Reverse the X-axis forces
+    
+    key = tuple([profile[name] for name in FACTOR_NAMES + GEOMETRY_NAMES] + [reverse])
+    if key in calibration_matrices:
+        return calibration_matrices[key]
+    
+    #--- Each plate uses the same factors on its own set of 8 columns
     #    X1, X2 - Raw force data for left-right direction of plate
     #    Y1, Y2 - Raw force data for front-back direction of plate
     #    Z1, Z2, Z3, Z4 - Raw force data for up-down direction of plate
-    p1_X1,p1_X2,p1_Y1,p1_Y2 =  data[:,0], data[:,1], data[:,2], data[:,3]
-    p1_Z1,p1_Z2,p1_Z3,p1_Z4 =  data[:,4], data[:,5], data[:,6], data[:,7]
+    z_factors = numpy.array([profile['Zc1'], profile['Zc2'],
+                             profile['Zc3'], profile['Zc4']])
+    cell_x = profile['cell_x'] * numpy.array([1, -1, -1, 1])
+    cell_y = profile['cell_y'] * numpy.array([1, 1, -1, -1])
+    matrix = numpy.zeros((NUM_COLUMNS, len(CHANNELS) + len(COP_CHANNELS)))
+    for plate in (0, 1):
+        column = plate*8
+        channel = plate*3
+        cop = len(CHANNELS) + plate*2
+        matrix[column+0:column+2, channel+0] = [profile['Xc1'], profile['Xc2']]
+        matrix[column+2:column+4, channel+1] = [profile['Yc1'], profile['Yc2']]
+        matrix[column+4:column+8, channel+2] = z_factors
+        
+        #--- The force on each Z-axis cell times its position on the plate
+        matrix[column+4:column+8, cop+0] = z_factors * cell_x
+        matrix[column+4:column+8, cop+1] = z_factors * cell_y
+        
+        #--- Reverse the X-axis in the same product for files that need it
+        if reverse:
+            matrix[:, channel+0] *= -1
+            matrix[:, cop+0] *= -1
+    
+    calibration_matrices[key] = matrix
+    return matrix
+
+#--- A function to find the calibration matrix to use for a file
+#    Returns the name of the profile and the matrix
+def fileCalibration(filename,                # Name of the file being read
+                    header,                  # Header code read from the file
+                    calibration_file = None, # File of calibration profiles
+                    profile = None):         # Name of the profile to use
+    name, profile = findProfile(filename, header, calibration_file, profile)
+    reverse = os.path.basename(filename) in profile['reverse']
+    return name, calibrationMatrix(profile, reverse)
+
+#--- Apply the conversion factors to the raw data for each plate
+#    Returns one array with a row for each of the X, Y and Z forces on
+#    plate 1 followed by plate 2 (see CHANNELS), and then a row for each
+#    of the moments (see COP_CHANNELS) if the matrix has them
+#    The forces are the same type as the raw data.
+#    Units: N = mV * N/mV
+def calibrate(data,   # Raw data with one column for each channel
+              matrix): # Calibration matrix from calibrationMatrix
+    return numpy.dot(matrix.T.astype(data.dtype, copy = False), data.T)
+
+#--- Filters that have already been designed
+filter_designs = {}
 
-    p2_X1,p2_X2,p2_Y1,p2_Y2 =  data[:,8], data[:,9], data[:,10], data[:,11]
-    p2_Z1,p2_Z2,p2_Z3,p2_Z4 =  data[:,12], data[:,13], data[:,14], data[:,15]
+#--- A function to design the filter for a scan rate
+#    A Butterworth low-pass filter and a notch filter (for mains hum) are
+#    put together as one set of second order sections.  Each design is
+#    kept, so a batch of files at the same rate only designs it once.
+#    Returns None if no filtering is asked for.
+def filterDesign(scan_rate,             # Hz
+                 lowpass = None,        # Low-pass cutoff in Hz
+                 notch = None,          # Notch frequency in Hz
+                 order = FILTER_ORDER): # Order of the low-pass filter
     
-    #--- Apply the conversion factors and add the data
-    #    Units: N = mV * N/mV
-    p1_X = p1_X1*Xc1 + p1_X2*Xc2
-    p1_Y = p1_Y1*Yc1 + p1_Y2*Yc2
-    p1_Z = p1_Z1*Zc1 + p1_Z2*Zc2 + p1_Z3*Zc3 + p1_Z4*Zc4
+    if lowpass is None and notch is None:
+        return None
     
-    p2_X = p2_X1*Xc1 + p2_X2*Xc2
-    p2_Y = p2_Y1*Yc1 + p2_Y2*Yc2
-    p2_Z = p2_Z1*Zc1 + p2_Z2*Zc2 + p2_Z3*Zc3 + p2_Z4*Zc4
+    key = (scan_rate, lowpass, notch, order)
+    if key in filter_designs:
+        return filter_designs[key]
     
-    #--- Reverse files that need to be reversed
-    if os.path.basename(filename) in REVERSE_LIST:
-        p1_X = -1 * p1_X
-        p2_X = -1 * p2_X
+    if scipy is None:
+        print "\nFiltering the forces needs SciPy, which could not be imported"
+        sys.exit()
     
-    #--- Put this data in the dictionary
-    #    Units: N
-    data_dict['p1_X'] = p1_X
-    data_dict['p1_Y'] = p1_Y
-    data_dict['p1_Z'] = p1_Z
+    nyquist = scan_rate / 2.0
+    for name, frequency in (('low-pass cutoff', lowpass), ('notch frequency', notch)):
+        if frequency is not None and not 0 < frequency < nyquist:
+            print "\nThe %s must be between 0 and half the scan rate" % (name)
+            print "\tScan rate: %s Hz" % (scan_rate)
+            print "\tGiven %s: %s Hz" % (name, frequency)
+            sys.exit()
+    
+    sections = []
+    if lowpass is not None:
+        sections.append(scipy.signal.butter(order, lowpass / nyquist, output='sos'))
+    if notch is not None:
+        b, a = scipy.signal.iirnotch(notch / nyquist, NOTCH_Q)
+        sections.append(scipy.signal.tf2sos(b, a))
+    sos = numpy.concatenate(sections)
+    
+    filter_designs[key] = sos
+    return sos
+
+#--- A function to filter every row of an array with zero phase
+#    The filter is run forward and backward along the last axis, so all
+#    of the channels are filtered in one call without shifting any peaks.
+def filterForces(forces, # Array with one row for each channel
+                 sos):   # Filter sections from filterDesign
     
-    data_dict['p2_X'] = p2_X
-    data_dict['p2_Y'] = p2_Y
-    data_dict['p2_Z'] = p2_Z
+    #--- Short trials are padded less than usual at each end
+    padlen = min(3*(2*len(sos) + 1), forces.shape[-1] - 1)
+    if padlen < 0:
+        return forces
+    filtered = scipy.signal.sosfiltfilt(sos, forces, axis = -1, padlen = padlen)
+    return filtered.astype(forces.dtype, copy = False)
+
+#--- A function to turn the moments of the Z-axis load cells into the
+#    center of pressure on each plate
+#    The moments are divided by the Z-axis force in place.  Frames where
+#    the force on a plate is not above min_force are set to NaN, so
+#    they are left out of plots and means.
+#    Units: m = N*m / N
+def centerOfPressure(moments,   # Moments with one row for each of COP_CHANNELS
+                     z,         # Z-axis force with one row for each plate
+                     min_force = COP_FORCE): # Least force to find it for
+    cop = moments.reshape(2, 2, -1)
+    z = z[:,numpy.newaxis,:]
+    loaded = z > min_force
+    numpy.divide(cop, z, out = cop, where = loaded)
+    numpy.copyto(cop, numpy.nan, where = ~loaded)
+    return moments
+
+#--- A function to find the mean of each center of pressure channel
+#    Only the frames where it was found count towards the mean
+#    Units: m
+def meanCenterOfPressure(cop): # Center of pressure from centerOfPressure
+    found = ~numpy.isnan(cop)
+    count = found.sum(axis = -1)
+    total = numpy.where(found, cop, 0.0).sum(axis = -1, dtype = numpy.float64)
+    mean = total / numpy.maximum(count, 1)
+    mean[count == 0] = numpy.nan
+    return mean
+
+#--- A function to find the contacts in each row of a force array
+#    A contact starts when the force rises above threshold_on and lasts
+#    until it falls below threshold_off, so noise around one threshold
+#    does not split a contact.  Contacts with fewer than min_frames
+#    frames are dropped.
+#    Returns a list with an array of (onset, offset) frames for each row,
+#    where the offset is the first frame after the contact
+def detectContacts(z,                      # Forces with one row per plate
+                   threshold_on = CONTACT_ON,   # Force to start a contact
+                   threshold_off = CONTACT_OFF, # Force to end a contact
+                   min_frames = 1):        # Fewest frames in a contact
     
+    z = numpy.atleast_2d(z)
+    rows, samples = z.shape
     
+    #--- Find the last frame at or before each frame that crossed a
+    #    threshold, and use it to tell whether each frame is in contact
+    above = z > threshold_on
+    below = z < threshold_off
+    frames = numpy.arange(samples)
+    last = numpy.where(above | below, frames, -1)
+    last = numpy.maximum.accumulate(last, axis = -1)
+    row_index = numpy.arange(rows)[:,numpy.newaxis]
+    contact = above[row_index, numpy.maximum(last, 0)] & (last >= 0)
     
-    #--- Get the magnitude of the force data in each direction
-    #    Units: N
-    data_dict['p1_XY_mag']  = (p1_X**2 + p1_Y**2)**0.5
-    data_dict['p1_XZ_mag']  = (p1_X**2 + p1_Z**2)**0.5
-    data_dict['p1_YZ_mag']  = (p1_Y**2 + p1_Z**2)**0.5
-    data_dict['p1_XYZ_mag'] = (p1_X**2 + p1_Y**2 + p1_Z**2)**0.5
+    #--- The edges of the contact give the onset and offset frames
+    edges = numpy.zeros((rows, samples + 1), dtype=numpy.int8)
+    edges[:,:samples] = contact
+    edges[:,1:] -= contact
     
-    data_dict['p2_XY_mag']  = (p2_X**2 + p2_Y**2)**0.5
-    data_dict['p2_XZ_mag']  = (p2_X**2 + p2_Z**2)**0.5
-    data_dict['p2_YZ_mag']  = (p2_Y**2 + p2_Z**2)**0.5
-    data_dict['p2_XYZ_mag'] = (p2_X**2 + p2_Y**2 + p2_Z**2)**0.5
+    contacts = []
+    for row in xrange(rows):
+        onsets = numpy.flatnonzero(edges[row] == 1)
+        offsets = numpy.flatnonzero(edges[row] == -1)
+        keep = (offsets - onsets) >= min_frames
+        contacts.append(numpy.column_stack((onsets[keep], offsets[keep])))
+    return contacts
 
-    #--- Set the frequency and find the time delta between frames
-    freq = scan_rate   # Hz
-    delta_t = 1.0/freq # s
-    data_dict['delta_t'] = delta_t
+#--- A function to find the impulse up to every frame of a trial
+#    Entry i of each row is the Trapezoid Rule impulse from the first
+#    frame to frame i, so the impulse between any two frames is just
+#    the difference of two entries
+#    The sum is always kept in double precision.
+#    Units: N*s
+def cumulativeImpulse(forces, # Calibrated forces with one row per channel
+                      delta_t): # Time between frames
+    cumulative = numpy.zeros(forces.shape)
+    if forces.shape[-1] > 1:
+        steps = (forces[...,1:] + forces[...,:-1]) * (delta_t / 2.0)
+        numpy.cumsum(steps, axis = -1, dtype = numpy.float64, out = cumulative[...,1:])
+    return cumulative
+
+#--- A function to find the net impulse on each row with the Trapezoid Rule
+#    This is numpy.trapz with the sum kept in double precision, so single
+#    precision forces do not lose accuracy over a long trial
+#    Units: N*s
+def trapezoid(forces,  # Calibrated forces with one row per channel
+              delta_t): # Time between frames
+    if forces.shape[-1] < 2:
+        return numpy.zeros(forces.shape[:-1])
+    total = forces.sum(axis = -1, dtype = numpy.float64)
+    ends = numpy.asarray(forces[...,0], dtype = numpy.float64) + forces[...,-1]
+    return (total - ends / 2.0) * delta_t
+
+#--- A function to find the net impulse in many windows of a trial
+#    Each window is a (start frame, end frame) pair like the -r option,
+#    so the end frame is not included.  Frame numbers are the same as in
+#    the trial's frame series.
+#    Returns an array with a row for each window and a column for each
+#    channel in CHANNELS
+#    Units: N*s
+def impulseWindows(trial,   # Trial from parseFile
+                   windows): # Sequence of (start frame, end frame) pairs
     
-    #--- From the number of frames generate a time series for plotting
-    #    If the user is inspecting the data then do not use the delta_t,
-    #    this will cause the plots to use the frame number on the x-axis
-    #
-    #    Don't forget to add the original start_frame to the beginning
-    #    to ensure the graph looks the same as before
-    frame = pylab.arange(0,len(data)) # This is an array-range data structure
-    frame += start_frame
-    data_dict['frame'] = frame
+    windows = numpy.asarray(windows, dtype=int).reshape(-1, 2)
+    start = windows[:,0] - trial['start_frame']
+    end = windows[:,1] - trial['start_frame']
+    
+    #--- Make sure every window is inside the trial
+    bad = (start < 0) | (end > trial.forces.shape[-1]) | (start >= end)
+    if bad.any():
+        print "\nYou cannot use windows outside the data or with no frames"
+        print "\tFrames in the data: %d to %d" % \
+              (trial['start_frame'], trial['start_frame'] + trial.forces.shape[-1])
+        for window in windows[bad]:
+            print "\tGiven Window: %d to %d" % tuple(window)
+        sys.exit()
+    
+    cumulative = trial['imp_cumulative']
+    return (cumulative[:,end - 1] - cumulative[:,start]).T
+
+#--- A trial holds the calibrated forces from a file along with its header
+#    information and results.  It can be used like the dictionary that
+#    parseFile used to return, but the magnitudes and the time and frame
+#    axes are only worked out the first time they are asked for.
+class KDATrial(object):
     
-    #--- Put the time information in the dictionary
-    time = frame*delta_t
-    data_dict['time'] = time
+    __slots__ = ['info', 'forces', 'cop', 'derived']
+    
+    #--- Names of the series that are worked out when first used
+    DERIVED = ['frame','time','imp_cumulative',
+               'p1_XY_mag','p1_XZ_mag','p1_YZ_mag','p1_XYZ_mag',
+               'p2_XY_mag','p2_XZ_mag','p2_YZ_mag','p2_XYZ_mag']
+    
+    def __init__(self,
+                 info,   # Dictionary of header information and results
+                 forces, # Calibrated forces with one row for each channel
+                 cop = None): # Center of pressure, one row for each of COP_CHANNELS
+        self.info = info
+        self.forces = forces
+        self.cop = cop
+        self.derived = {}
+    
+    def __getitem__(self, key):
+        if key in CHANNELS:
+            return self.forces[CHANNELS.index(key)]
+        if key in COP_CHANNELS and self.cop is not None:
+            return self.cop[COP_CHANNELS.index(key)]
+        if key in self.info:
+            return self.info[key]
+        if key not in self.derived:
+            with timers.stage('derive'):
+                self.derived[key] = self.derive(key)
+        return self.derived[key]
+    
+    def __setitem__(self, key, value):
+        if key in CHANNELS:
+            self.forces[CHANNELS.index(key)] = value
+        elif key in COP_CHANNELS and self.cop is not None:
+            self.cop[COP_CHANNELS.index(key)] = value
+        elif key in self.DERIVED:
+            self.derived[key] = value
+        else:
+            self.info[key] = value
+    
+    def __contains__(self, key):
+        if key in COP_CHANNELS and self.cop is not None:
+            return True
+        return key in CHANNELS or key in self.info or key in self.DERIVED
+    
+    def __getstate__(self):
+        return self.info, self.forces, self.cop
+    
+    def __setstate__(self, state):
+        self.info, self.forces = state[:2]
+        self.cop = None
+        if len(state) > 2:
+            self.cop = state[2]
+        self.derived = {}
+    
+    def keys(self):
+        cop_keys = []
+        if self.cop is not None:
+            cop_keys = COP_CHANNELS
+        return CHANNELS + cop_keys + self.DERIVED + self.info.keys()
+    
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+    
+    def summary(self):
+        """A copy of the header information and results without the data"""
+        return dict(self.info)
+    
+    def derive(self, key):
+        """Work out one of the derived series from the forces"""
+        
+        #--- From the number of frames generate a time series for plotting
+        #    If the user is inspecting the data then do not use the delta_t,
+        #    this will cause the plots to use the frame number on the x-axis
+        #
+        #    Don't forget to add the original start_frame to the beginning
+        #    to ensure the graph looks the same as before
+        if key == 'frame':
+            frame = numpy.arange(0,self.forces.shape[-1])
+            frame += self.info['start_frame']
+            return frame
+        if key == 'time':
+            return numpy.multiply(self['frame'], self.info['delta_t'],
+                                  dtype = self.forces.dtype)
+        
+        #--- The cumulative impulse is read from the cache if it is there
+        if key == 'imp_cumulative':
+            path = self.info.get('cumulative_path')
+            if path and os.path.isfile(path):
+                try:
+                    cumulative = numpy.load(path, mmap_mode='r')
+                    os.utime(path, None)
+                    return cumulative
+                except (IOError, OSError, ValueError):
+                    pass
+            cumulative = cumulativeImpulse(self.forces, self.info['delta_t'])
+            if path:
+                try:
+                    saveArray(path, cumulative)
+                except (IOError, OSError), error:
+                    print >> sys.stderr, "Unable to cache %s: %s" % (path, error)
+            return cumulative
+        
+        #--- Get the magnitude of the force data in the given directions
+        #    Units: N
+        if key in self.DERIVED:
+            plate, axes = key.split('_')[:2]
+            total = numpy.zeros(self.forces.shape[-1], dtype = self.forces.dtype)
+            for axis in axes:
+                channel = self['%s_%s' % (plate, axis)]
+                total += channel*channel
+            return numpy.sqrt(total)
+        
+        raise KeyError(key)
+
+def parseFile(filename,                # Name of the file to parse
+              range = (-1, -1),        # Frame range
+              cache_dir = None,        # Directory holding the cache
+              rebuild_cache = False,   # Ignore and replace any cached copy
+              cache_size = CACHE_SIZE, # Maximum size of the cache in MB
+              cache_hash = False,      # Check a hash of the contents too
+              calibration_file = None, # File of calibration profiles
+              profile = None,          # Name of the calibration profile
+              sigma = None,            # Sigma edit threshold for the weight
+              sigma_window = None,     # Rolling window for the sigma edit
+              contact_on = CONTACT_ON,   # Force to start a contact
+              contact_off = CONTACT_OFF, # Force to end a contact
+              contact_min = CONTACT_MIN, # Shortest contact in seconds
+              windows = None,          # Frame windows to find the impulse in
+              lowpass = None,          # Low-pass cutoff in Hz
+              notch = None,            # Notch frequency in Hz
+              dtype = numpy.float64,   # Type to store the samples as
+              cop_force = COP_FORCE):  # Least force to find the center of pressure for
+    
+    #--- Read the header and the data using another function
+    #    This returns useful information to verify the file and name it
+    #    along with the data from the file, either from the cache or
+    #    from the file itself in a single pass
+    header, timestamp, scan_rate, total_scans, trigger_state, data = \
+        loadKDA(filename,
+                cache_dir = cache_dir,
+                rebuild_cache = rebuild_cache,
+                cache_size = cache_size,
+                cache_hash = cache_hash,
+                dtype = dtype)
+    
+    #--- We will save the header information and results to a dictionary
+    info = fileInfo(filename, header, timestamp, scan_rate, total_scans, trigger_state)
+    delta_t = info['delta_t']
+    
+    #--- Do some internal checking on the data
+    #    compare the data length against the file's header information
+    checkRecords(len(data), total_scans)
+    
+    #--- Slice the data to the desired range of frames
+    #    Cached data is double precision, so only the slice is converted
+    start_frame, end_frame = frameRange(range, len(data))
+    data = numpy.asarray(data[start_frame:end_frame], dtype = dtype)
+    info['start_frame'] = start_frame
+    
+    #--- Calibrate the data to get the force on each plate, along with the
+    #    moments of the Z-axis load cells for the center of pressure
+    #    Units: N and N*m
+    with timers.stage('calibrate'):
+        info['calibration'], matrix = fileCalibration(filename, header,
+                                                      calibration_file, profile)
+        channels = calibrate(data, matrix)
+    
+    #--- Filter all of the calibrated channels at once if asked to
+    #    Filtering the forces is the same as filtering the raw columns,
+    #    since calibration is linear, but there are fewer rows to filter
+    sos = filterDesign(scan_rate, lowpass, notch)
+    if sos is not None:
+        with timers.stage('filter'):
+            channels = filterForces(channels, sos)
+    forces = channels[:len(CHANNELS)]
+    
+    #--- Find the center of pressure on each plate where it is loaded
+    #    Units: m
+    with timers.stage('cop'):
+        cop = centerOfPressure(channels[len(CHANNELS):], forces[[2,5]], cop_force)
+    for channel, channel_mean in zip(COP_CHANNELS, meanCenterOfPressure(cop)):
+        info['%s_mean' % channel] = channel_mean
     
     #--- Calculate the total time for the given data range
     #    Units: s
-    data_dict['total_time'] = len(frame)*delta_t
+    info['total_time'] = len(data)*delta_t
     
     #--- Use the Trapezoid Rule to calculate the net impulse for each plate
-    #    NOTE: Do not set 'x' unless using variable sampling rate
     #    Units: N*s
-    data_dict['p1_X_imp_net'] = numpy.trapz(p1_X, x = None, dx = delta_t, axis = -1)
-    data_dict['p1_Y_imp_net'] = numpy.trapz(p1_Y, x = None, dx = delta_t, axis = -1)
-    data_dict['p1_Z_imp_net'] = numpy.trapz(p1_Z, x = None, dx = delta_t, axis = -1)
+    with timers.stage('integrate'):
+        imp_net = trapezoid(forces, delta_t)
+    for channel, channel_imp_net in zip(CHANNELS, imp_net):
+        info['%s_imp_net' % channel] = channel_imp_net
+    
+    #--- Find the average force on each plate for the weight
+    #    Units: N
+    with timers.stage('weight'):
+        info['p1_weight'], info['p2_weight'] = plateWeight(forces, sigma, sigma_window)
+    
+    #--- Find when the subject is on each plate using the Z-axis force
+    #    The frames are offset by the start_frame like the frame series.
+    #    The first onset on either plate can be used to align the data.
+    min_frames = max(int(round(contact_min*scan_rate)), 1)
+    with timers.stage('contacts'):
+        p1_contacts, p2_contacts = detectContacts(forces[[2,5]],
+                                                  contact_on, contact_off, min_frames)
+    info['p1_contacts'] = p1_contacts + start_frame
+    info['p2_contacts'] = p2_contacts + start_frame
+    onsets = numpy.concatenate((p1_contacts[:,0], p2_contacts[:,0]))
+    info['contact_frame'] = None
+    if len(onsets):
+        info['contact_frame'] = int(onsets.min()) + start_frame
     
-    data_dict['p2_X_imp_net'] = numpy.trapz(p2_X, x = None, dx = delta_t, axis = -1)
-    data_dict['p2_Y_imp_net'] = numpy.trapz(p2_Y, x = None, dx = delta_t, axis = -1)
-    data_dict['p2_Z_imp_net'] = numpy.trapz(p2_Z, x = None, dx = delta_t, axis = -1)
+    data_dict = KDATrial(info, forces, cop)
     
+    #--- Keep the cumulative impulse with the cached file if caching
+    if cache_dir is not None:
+        info['cumulative_path'] = cumulativePath(filename, cache_dir, matrix,
+                                                 start_frame, len(data), sos, dtype)
+    
+    #--- Find the net impulse in each of the requested windows
+    #    Units: N*s
+    if windows is not None:
+        info['windows'] = numpy.asarray(windows, dtype=int).reshape(-1, 2)
+        with timers.stage('windows'):
+            info['window_imp_net'] = impulseWindows(data_dict, windows)
     
     #--- First Derivative
     #
@@ -321,18 +1619,567 @@ def parseFile(filename,             # Name of the file to parse
     
     return data_dict
 
+#--- Keep running totals of the impulse and force on each channel
+#    This lets a file be integrated a chunk at a time without keeping
+#    all of the data in memory.  The last sample of each chunk is kept
+#    so the trapezoid between two chunks is not lost.
+class RunningSummary(object):
+    
+    def __init__(self, delta_t): # Time between frames
+        self.delta_t = delta_t
+        self.count = 0
+        self.last = None
+        self.force_sum = numpy.zeros(6)
+        self.imp_net = numpy.zeros(6)
+    
+    def update(self, forces): # Array of calibrated forces, one row per channel
+        if not forces.shape[-1]:
+            return
+        
+        #--- Add the trapezoid joining this chunk to the last one
+        if self.last is not None:
+            self.imp_net += (self.last + forces[:,0]) * self.delta_t / 2.0
+        
+        #--- Use the Trapezoid Rule within the chunk
+        self.imp_net += numpy.trapz(forces, x = None, dx = self.delta_t, axis = -1)
+        self.force_sum += forces.sum(axis = -1)
+        self.count += forces.shape[-1]
+        self.last = forces[:,-1].copy()
+    
+    def results(self, data_dict): # Dictionary to put the results in
+        
+        #--- Calculate the total time for the frames seen so far
+        #    Units: s
+        data_dict['total_time'] = self.count*self.delta_t
+        
+        #--- Put the net impulse for each plate in the dictionary
+        #    Units: N*s
+        for channel, imp_net in zip(CHANNELS, self.imp_net):
+            data_dict['%s_imp_net' % channel] = imp_net
+        
+        #--- Find the average force on each plate for the weight
+        #    Units: N
+        if self.count:
+            data_dict['p1_weight'] = self.force_sum[2] / self.count
+            data_dict['p2_weight'] = self.force_sum[5] / self.count
+        return data_dict
+
+#--- Find the impulse and weight for a file without loading all of it
+#    Only the summary is returned, so the data cannot be plotted, but the
+#    memory used stays the same no matter how long the file is
+def streamFile(filename,                # Name of the file to parse
+               range = (-1, -1),        # Frame range
+               chunk_rows = CHUNK_ROWS, # Number of rows to read at a time
+               calibration_file = None, # File of calibration profiles
+               profile = None):         # Name of the calibration profile
+    
+    #--- Open the file in a read-only state and read the header rows
+    file = open(filename, 'rb')
+    lines = [file.readline() for i in xrange(HEADER_ROWS)]
+    header, timestamp, scan_rate, total_scans, trigger_state = parseHeaderLines(lines)
+    
+    #--- We will save the data to a dictionary
+    data_dict = fileInfo(filename, header, timestamp, scan_rate, total_scans, trigger_state)
+    delta_t = data_dict['delta_t']
+    
+    #--- The range is checked against the header since the file is not
+    #    read yet.  The number of records is checked once it has been.
+    start_frame, end_frame = frameRange(range, total_scans)
+    
+    #--- Find the calibration once for every chunk in the file
+    #    Only the forces are needed for the running sums
+    data_dict['calibration'], matrix = fileCalibration(filename, header,
+                                                       calibration_file, profile)
+    matrix = matrix[:,:len(CHANNELS)]
+    
+    #--- Read the file a chunk at a time, only using the frames in range
+    summary = RunningSummary(delta_t)
+    found = 0
+    while True:
+        with timers.stage('read'):
+            block = ''.join(itertools.islice(file, chunk_rows))
+            rows, values = decodeRows(block)
+        if not block:
+            break
+        if len(values) != rows*NUM_COLUMNS:
+            file.close()
+            raise ValueError("Unable to decode the records starting at record %d in %s" % \
+                             (found, filename))
+        chunk = values.reshape(rows, NUM_COLUMNS)
+        chunk = chunk[max(start_frame - found, 0):max(end_frame - found, 0)]
+        found += rows
+        
+        with timers.stage('calibrate'):
+            forces = calibrate(chunk, matrix)
+        with timers.stage('integrate'):
+            summary.update(forces)
+    file.close()
+    
+    #--- Do some internal checking on the data
+    #    compare the data length against the file's header information
+    checkRecords(found, total_scans)
+    
+    return summary.results(data_dict)
+
+#--- A function to follow a file while it is still being written
+#    New rows are read as they are added to the file, without reading
+#    anything twice, and the running impulse and weight are printed and
+#    plotted at most fps times a second.  Returns the results once the
+#    file has all of the records in its header, or when stop() is True.
+def followFile(filename,                 # Name of the file to follow
+               interval = FOLLOW_INTERVAL, # Seconds between checks for new data
+               fps = FOLLOW_FPS,         # Most updates each second
+               window = FOLLOW_WINDOW,   # Seconds of the latest data to plot
+               calibration_file = None,  # File of calibration profiles
+               profile = None,           # Name of the calibration profile
+               show_weight = False,      # Print the weight instead of impulse
+               plot_keys = None,         # Channels to plot, such as 'p1_Z'
+               stop = None):             # Function that is True to stop early
+    
+    #--- Read the file with low level reads so that data added after the
+    #    end of the file was reached is always seen
+    fd = os.open(filename, os.O_RDONLY)
+    buffer = ''
+    offset = 0
+    data_dict = None
+    
+    #--- Set up a plot of the latest data if requested
+    fig = None
+    if plot_keys:
+        fig = pylab.figure()
+        axes = fig.gca()
+        color_list = ['b','g','r','c','m','y','k']
+        lines = {}
+        for index, key in enumerate(plot_keys):
+            lines[key], = axes.plot([], [], '-%s' % color_list[index % len(color_list)], label=key)
+        axes.legend(loc='upper left')
+        axes.set_xlabel('Time (s)')
+        axes.set_ylabel('Force (N)')
+        axes.set_title('%s\nLive Force Plot' % os.path.basename(filename))
+        axes.grid(True)
+    
+    try:
+        last_update = 0.0
+        changed = False
+        while True:
+            
+            #--- Start again if the file was replaced by a shorter one
+            if os.fstat(fd).st_size < offset:
+                os.lseek(fd, 0, os.SEEK_SET)
+                buffer = ''
+                offset = 0
+                data_dict = None
+            
+            block = os.read(fd, 1 << 20)
+            offset += len(block)
+            buffer += block
+            
+            #--- Wait until the whole header has been written
+            if data_dict is None:
+                if buffer.count('\n') < HEADER_ROWS:
+                    time.sleep(interval)
+                    continue
+                header_lines = buffer.split('\n', HEADER_ROWS)
+                buffer = header_lines.pop()
+                header, timestamp, scan_rate, total_scans, trigger_state = \
+                    parseHeaderLines([line + '\n' for line in header_lines])
+                data_dict = fileInfo(filename, header, timestamp, scan_rate,
+                                     total_scans, trigger_state)
+                data_dict['calibration'], matrix = fileCalibration(filename, header,
+                                                                   calibration_file, profile)
+                matrix = matrix[:,:len(CHANNELS)]
+                summary = RunningSummary(data_dict['delta_t'])
+                recent = numpy.zeros((len(CHANNELS), 0))
+                window_frames = max(int(window*scan_rate), 1)
+            
+            #--- Only decode complete rows, keeping a partial row for later
+            cut = buffer.rfind('\n') + 1
+            if cut:
+                rows, values = decodeRows(buffer[:cut])
+                buffer = buffer[cut:]
+                if len(values) != rows*NUM_COLUMNS:
+                    raise ValueError("Unable to decode the records starting at record %d in %s" % \
+                                     (summary.count, filename))
+                if rows:
+                    forces = calibrate(values.reshape(rows, NUM_COLUMNS), matrix)
+                    summary.update(forces)
+                    if fig:
+                        recent = numpy.concatenate((recent, forces), axis = -1)[:,-window_frames:]
+                    changed = True
+            
+            finished = summary.count >= data_dict['total_scans']
+            
+            #--- Update the results and the plot at a limited rate
+            now = time.time()
+            if changed and (finished or now - last_update >= 1.0/fps):
+                summary.results(data_dict)
+                if show_weight:
+                    weight(data_dict)
+                else:
+                    impulse(data_dict)
+                sys.stdout.flush()
+                
+                if fig:
+                    start = summary.count - recent.shape[-1]
+                    t = numpy.arange(start, summary.count) * data_dict['delta_t']
+                    pixels = max(int(axes.get_window_extent().width), 1)
+                    for key in plot_keys:
+                        y = recent[CHANNELS.index(key)]
+                        lines[key].set_data(*decimateMinMax(t, y, pixels))
+                    axes.relim()
+                    axes.autoscale_view()
+                    fig.canvas.draw_idle()
+                    pylab.pause(0.001)
+                
+                last_update = now
+                changed = False
+            
+            if finished or (stop is not None and stop()):
+                break
+            if not block:
+                time.sleep(interval)
+    finally:
+        os.close(fd)
+    
+    if data_dict is not None:
+        summary.results(data_dict)
+    return data_dict
+
+#--- A function to follow the newest file in a directory as it is written
+#    When a newer file appears the current file is left and the newer
+#    file is followed.  This runs until it is interrupted.
+def followDirectory(dirName,                # Directory to watch
+                    interval = FOLLOW_INTERVAL, # Seconds between checks for new data
+                    **kwargs):              # Keywords for followFile
+    
+    def newest():
+        file_list = []
+        for ext in FILE_EXT_LIST:
+            file_list.extend(glob.glob(os.path.join(dirName, ext)))
+        if not file_list:
+            return None
+        return max(file_list, key = lambda file: (os.path.getmtime(file), file))
+    
+    current = None
+    while True:
+        filename = newest()
+        if filename is None or filename == current:
+            time.sleep(max(interval, 0.5))
+            continue
+        current = filename
+        
+        #--- Check for a newer file at most once a second
+        checked = [time.time()]
+        def stop():
+            if time.time() - checked[0] < 1.0:
+                return False
+            checked[0] = time.time()
+            return newest() != current
+        
+        followFile(current, interval = interval, stop = stop, **kwargs)
+
+#--- A function to stack the forces from a set of trials into one array
+#    Returns an array of trials x channels x samples with shorter trials
+#    padded with zeros, the number of samples in each trial, and a mask
+#    that is True for every sample that came from a trial.  The stack is
+#    single precision only if every trial is.
+def stackTrials(trials): # List of trials from parseFile
+    
+    lengths = numpy.array([trial.forces.shape[-1] for trial in trials], dtype=int)
+    samples = 0
+    dtype = numpy.float64
+    if len(trials):
+        samples = lengths.max()
+        dtype = numpy.result_type(*[trial.forces for trial in trials])
+    
+    stack = numpy.zeros((len(trials), len(CHANNELS), samples), dtype=dtype)
+    for index, trial in enumerate(trials):
+        stack[index, :, :lengths[index]] = trial.forces
+    mask = numpy.arange(samples) < lengths[:,numpy.newaxis]
+    
+    return stack, lengths, mask
+
+#--- A function to find the magnitude of the force for a stack of trials
+#    Returns a masked array of trials x plates x samples
+def stackMagnitude(stack, # Forces from stackTrials
+                   mask,  # Mask from stackTrials
+                   axes = 'XYZ'): # Axes to include in the magnitude
+    
+    #--- Pick the channels for the given axes on both plates at once
+    #    Units: N
+    index = ['XYZ'.index(axis) for axis in axes]
+    plates = stack.reshape(len(stack), 2, 3, -1)[:,:,index,:]
+    magnitude = numpy.sqrt((plates*plates).sum(axis = 2))
+    
+    plate_mask = numpy.repeat(~mask[:,numpy.newaxis,:], 2, axis = 1)
+    return numpy.ma.masked_array(magnitude, mask = plate_mask)
+
+#--- A function to find the impulse and weight for many trials at once
+#    Returns a record array with one row for each trial, which can be
+#    printed with impulse() and weight() just like a trial
+def batchSummary(trials,              # List of trials from parseFile
+                 sigma = None,        # Sigma edit threshold for the weight
+                 sigma_window = None): # Rolling window for the sigma edit
+    
+    stack, lengths, mask = stackTrials(trials)
+    delta_t = numpy.array([trial['delta_t'] for trial in trials])
+    
+    #--- Build the weights for the Trapezoid Rule for every trial at once
+    #    Each sample counts for a full time step except the first and last
+    #    samples of each trial, which count for half.  Padding counts for
+    #    nothing.
+    #    Units: s
+    step = mask * delta_t[:,numpy.newaxis]
+    rows = numpy.arange(len(trials))
+    step[rows[lengths > 0], 0] /= 2.0
+    step[rows[lengths > 0], lengths[lengths > 0] - 1] /= 2.0
+    step[rows[lengths == 1], 0] = 0.0
+    
+    #--- Use the Trapezoid Rule to calculate the net impulse for each plate
+    #    The sums are kept in double precision even for single precision forces
+    #    Units: N*s
+    imp_net = numpy.einsum('tcs,ts->tc', stack, step, dtype = numpy.float64)
+    
+    #--- Find the average force on each plate for the weight
+    #    Units: N
+    if sigma is None:
+        count = numpy.maximum(lengths, 1)
+        weights = stack[:,[2,5],:].sum(axis = -1, dtype = numpy.float64) / count[:,numpy.newaxis]
+    else:
+        padding = numpy.repeat(~mask[:,numpy.newaxis,:], 2, axis = 1)
+        weights = plateWeight(stack, sigma, sigma_window, mask = padding)
+    
+    #--- Put the results into a record array
+    name_size = max([1] + [len(trial['filename']) for trial in trials])
+    fields = [('filename', 'S%d' % name_size),
+              ('timestamp', 'S20'),
+              ('total_time', float)]
+    fields += [('%s_imp_net' % channel, float) for channel in CHANNELS]
+    fields += [('p1_weight', float), ('p2_weight', float)]
+    summary = numpy.zeros(len(trials), dtype = fields)
+    
+    summary['filename'] = [trial['filename'] for trial in trials]
+    summary['timestamp'] = [trial['timestamp'] for trial in trials]
+    summary['total_time'] = lengths * delta_t
+    for index, channel in enumerate(CHANNELS):
+        summary['%s_imp_net' % channel] = imp_net[:,index]
+    summary['p1_weight'] = weights[:,0]
+    summary['p2_weight'] = weights[:,1]
+    
+    return summary
+
+#--- Resampled forces that have already been worked out, by trial and rate
+resampled_forces = {}
+
+#--- A function to resample the forces of one trial with the FFT
+#    The spectrum is cut off or padded with zeros to the new length
+def resampleFFT(forces,   # Calibrated forces with one row per channel
+                frames):  # Number of frames to resample to
+    spectrum = numpy.fft.rfft(forces, axis = -1)
+    resampled = numpy.zeros(forces.shape[:-1] + (frames//2 + 1,), dtype = spectrum.dtype)
+    bins = min(spectrum.shape[-1], resampled.shape[-1])
+    resampled[...,:bins] = spectrum[...,:bins]
+    return numpy.fft.irfft(resampled, frames, axis = -1) * (frames / float(forces.shape[-1]))
+
+#--- A function to bring every trial onto the same rate
+#    The first sample of each trial stays at the same time, so the trials
+#    share a time grid of 1/rate steps from their start frame (which is
+#    rounded to the new rate).  Trials at the same scan rate are padded
+#    and resampled together in one call with the polyphase filter, which
+#    gives the same samples as resampling each trial on its own.  The
+#    resampled forces are kept for each trial and rate, and saved with
+#    the cumulative impulse when caching.
+#    Returns a new trial for each trial, with its frames, contacts and
+#    alignment moved to the new rate and the old rate as 'source_rate'.
+def resampleTrials(trials,           # List of trials from parseFile
+                   rate,             # Hz
+                   method = 'poly'): # One of RESAMPLE_METHODS
+    
+    if method == 'poly' and scipy is None:
+        print "\nResampling with a polyphase filter needs SciPy, which could not be imported"
+        print "\tUse the fft method instead"
+        sys.exit()
+    
+    #--- Find the trials that have not been resampled before
+    keys = []
+    paths = []
+    groups = {}
+    for index, trial in enumerate(trials):
+        path = trial.get('cumulative_path')
+        if path:
+            path = '%s.%s_%d.npy' % (path[:-len('.cum.npy')], method, rate)
+        key = (os.path.abspath(trial['filename']), trial['start_frame'],
+               trial.forces.shape[-1], trial.forces.dtype.str,
+               trial.get('calibration'), path, rate, method)
+        keys.append(key)
+        paths.append(path)
+        if key in resampled_forces or trial['scan_rate'] == rate:
+            continue
+        if path and os.path.isfile(path):
+            try:
+                resampled_forces[key] = numpy.load(path)
+                os.utime(path, None)
+                continue
+            except (IOError, OSError, ValueError):
+                pass
+        groups.setdefault(trial['scan_rate'], []).append(index)
+    
+    #--- Resample the trials from each scan rate
+    #    The resampled forces are stored as the same type as the trial
+    for scan_rate, indexes in groups.items():
+        ratio = fractions.Fraction(int(rate), int(scan_rate))
+        if method == 'fft':
+            for index in indexes:
+                forces = trials[index].forces
+                frames = max(int(round(forces.shape[-1]*ratio)), 1)
+                resampled_forces[keys[index]] = resampleFFT(forces, frames).astype(forces.dtype)
+            continue
+        
+        #--- Pad the trials to the same length and resample them at once
+        lengths = [trials[index].forces.shape[-1] for index in indexes]
+        stack = numpy.zeros((len(indexes), len(CHANNELS), max(lengths)))
+        for row, index in enumerate(indexes):
+            stack[row,:,:lengths[row]] = trials[index].forces
+        stack = scipy.signal.resample_poly(stack, ratio.numerator, ratio.denominator, axis = -1)
+        for row, index in enumerate(indexes):
+            frames = -(-lengths[row]*ratio.numerator // ratio.denominator)
+            resampled_forces[keys[index]] = stack[row,:,:frames].astype(trials[index].forces.dtype)
+    
+    #--- Make the new trials, saving any newly resampled forces
+    resampled = []
+    for index, trial in enumerate(trials):
+        if trial['scan_rate'] == rate:
+            resampled.append(trial)
+            continue
+        forces = resampled_forces[keys[index]]
+        if paths[index] and not os.path.isfile(paths[index]):
+            try:
+                saveArray(paths[index], forces)
+            except (IOError, OSError), error:
+                print >> sys.stderr, "Unable to cache %s: %s" % (paths[index], error)
+        
+        scale = float(rate) / trial['scan_rate']
+        info = dict(trial.info)
+        info['source_rate'] = trial['scan_rate']
+        info['scan_rate'] = rate
+        info['delta_t'] = 1.0/rate
+        info['total_time'] = forces.shape[-1]*info['delta_t']
+        info['start_frame'] = int(round(trial['start_frame']*scale))
+        for name in ('p1_contacts', 'p2_contacts'):
+            if name in info:
+                info[name] = numpy.round(info[name]*scale).astype(int)
+        for name in ('contact_frame', 'align'):
+            if info.get(name) is not None:
+                info[name] = int(round(info[name]*scale))
+        if info.get('cumulative_path'):
+            info['cumulative_path'] = paths[index][:-len('.npy')] + '.cum.npy'
+        
+        #--- The center of pressure is NaN where a plate is not loaded, so
+        #    it takes the nearest old sample instead of being filtered
+        cop = None
+        if trial.cop is not None:
+            source = numpy.round(numpy.arange(forces.shape[-1]) / scale).astype(int)
+            cop = trial.cop[:,numpy.minimum(source, trial.cop.shape[-1] - 1)]
+        resampled.append(KDATrial(info, forces, cop))
+    
+    return resampled
+
+#--- Windows and frequencies for power spectra, by scan rate and length
+spectrum_windows = {}
+
+#--- A function to find the window for each segment of a power spectrum
+#    Returns the periodic Hann window, the scale that turns the squared
+#    FFT into a density, and the frequency of each bin
+def spectrumWindow(scan_rate, # Hz
+                   nperseg):  # Number of samples in each segment
+    
+    key = (scan_rate, nperseg)
+    if key not in spectrum_windows:
+        window = 0.5 - 0.5*numpy.cos(2*numpy.pi*numpy.arange(nperseg)/float(nperseg))
+        scale = 1.0 / (scan_rate * (window*window).sum())
+        freq = numpy.fft.rfftfreq(nperseg, 1.0/scan_rate)
+        spectrum_windows[key] = (window, scale, freq)
+    return spectrum_windows[key]
+
+#--- A function to find the power spectral density of each channel of
+#    each trial with Welch's method.  Each trial is cut into segments
+#    that overlap by half, and the segments of all the trials with the
+#    same scan rate and segment length are transformed in one real FFT.
+#    The spectra are put in each trial as 'psd_freq' and 'psd' (one row
+#    for each channel), along with the dominant frequency of each channel
+#    above 0 Hz as '<channel>_peak_freq'.
+#    Units: N^2/Hz
+def powerSpectra(trials,                     # List of trials from parseFile
+                 segment = SPECTRUM_SEGMENT): # Seconds in each segment
+    
+    #--- Group the trials that can be transformed together
+    groups = {}
+    for index, trial in enumerate(trials):
+        frames = trial.forces.shape[-1]
+        nperseg = min(int(round(segment*trial['scan_rate'])), frames)
+        if nperseg < 2:
+            continue
+        groups.setdefault((trial['scan_rate'], nperseg), []).append(index)
+    
+    for (scan_rate, nperseg), indexes in groups.items():
+        window, scale, freq = spectrumWindow(scan_rate, nperseg)
+        step = nperseg - nperseg//2
+        
+        #--- Make a view of the segments of each trial without copying it
+        #    Segments: channels x segments x samples
+        segments = []
+        for index in indexes:
+            forces = numpy.ascontiguousarray(trials[index].forces)
+            count = (forces.shape[-1] - nperseg) // step + 1
+            strides = forces.strides
+            segments.append(numpy.lib.stride_tricks.as_strided(forces,
+                                shape = (forces.shape[0], count, nperseg),
+                                strides = (strides[0], strides[1]*step, strides[1])))
+        counts = [view.shape[1] for view in segments]
+        stack = numpy.concatenate(segments, axis = 1)
+        
+        #--- Take the mean out of each segment and transform them all
+        stack -= stack.mean(axis = -1)[...,numpy.newaxis]
+        stack *= window
+        power = numpy.fft.rfft(stack, axis = -1)
+        power = (power.real**2 + power.imag**2) * scale
+        
+        #--- Fold the negative frequencies into the one sided spectrum
+        if nperseg % 2:
+            power[...,1:] *= 2
+        else:
+            power[...,1:-1] *= 2
+        
+        #--- Average the segments of each trial
+        start = 0
+        for index, count in zip(indexes, counts):
+            psd = power[:,start:start+count].mean(axis = 1)
+            start += count
+            
+            trial = trials[index]
+            trial['psd_freq'] = freq
+            trial['psd'] = psd
+            for channel, channel_psd in zip(CHANNELS, psd):
+                peak_freq = numpy.nan
+                if len(freq) > 1:
+                    peak_freq = freq[1 + channel_psd[1:].argmax()]
+                trial['%s_peak_freq' % channel] = peak_freq
+    
+    return trials
+
 #--- Define headers that will be printed for weight or impulse data
-def weight_header():
+#    Rows are printed to out, or to stdout when out is None
+def weight_header(out = None):
     """This is the header for weight information"""
-    print "#%s%s%s%s%s" % (str("File"     ).rjust(14,' '),
+    print >> out, "#%s%s%s%s%s" % (str("File"     ).rjust(14,' '),
                           str("P1 (N)"    ).rjust(15,' '),
                           str("P2 (N)"    ).rjust(15,' '),
                           str("Total (N)" ).rjust(15,' '),
                           str("Total (kg)").rjust(15,' '))
 
-def impulse_header():
+def impulse_header(out = None):
     """This is the header for impulse information"""
-    print "#%s%s%s%s%s%s%s%s%s" % (str('File'    ).rjust(14,' '),
+    print >> out, "#%s%s%s%s%s%s%s%s%s" % (str('File'    ).rjust(14,' '),
                                   str('Timestamp').rjust(20,' '),
                                   str('Time (s)' ).rjust(10,' '),
                                   str('P1 X (Ns)').rjust(10,' '),
@@ -343,27 +2190,46 @@ def impulse_header():
                                   str('P2 Z (Ns)').rjust(10,' ')) 
 
 
+#--- Print the contacts found on each plate of a file
+def contacts_header():
+    """This is the header for contact information"""
+    print "#%s%s%s%s%s" % (str('File'        ).rjust(14,' '),
+                          str('Plate'       ).rjust(6,' '),
+                          str('Onset'       ).rjust(10,' '),
+                          str('Offset'      ).rjust(10,' '),
+                          str('Duration (s)').rjust(14,' '))
+
+def contacts(data_dict):
+    """A method to print the contacts found when the file was parsed"""
+    
+    filename = data_dict['filename']
+    delta_t = data_dict['delta_t']
+    for plate in ('1', '2'):
+        for onset, offset in data_dict['p%s_contacts' % plate]:
+            print "%s%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
+                                  str('%s'   % plate     ).rjust(6,' '),
+                                  str('%d'   % onset     ).rjust(10,' '),
+                                  str('%d'   % offset    ).rjust(10,' '),
+                                  str('%.3f' % ((offset - onset)*delta_t)).rjust(14,' '))
+
 #--- Determine the mass of the subject on each plate
 #    After determining the weight exit the program
-def weight(data_dict):
+def weight(data_dict, out = None):
     
     filename = data_dict['filename']
-    p1_Z = data_dict['p1_Z']
-    p2_Z = data_dict['p2_Z']
-    
-    p1_weight = pylab.mean(p1_Z) # N
-    p2_weight = pylab.mean(p2_Z) # N
+    p1_weight = data_dict['p1_weight'] # N
+    p2_weight = data_dict['p2_weight'] # N
     total_weight = p1_weight + p2_weight # N
     total_mass = total_weight / GRAVITY  # kg
     
-    print "%s%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
+    print >> out, "%s%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
                           str('%.3f' % p1_weight   ).rjust(15,' '),
                           str('%.3f' % p2_weight   ).rjust(15,' '),
                           str('%.3f' % total_weight).rjust(15,' '),
                           str('%.3f' % total_mass  ).rjust(15,' '))
     return 0
 
-def impulse(data_dict):
+def impulse(data_dict, out = None):
     """A method to calculate the total impulse"""
     
     filename = data_dict['filename']
@@ -377,7 +2243,7 @@ def impulse(data_dict):
     p2_Z_imp_net = data_dict['p2_Z_imp_net']
     
     #--- Print the results of the total impulse
-    print "%s%s%s%s%s%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
+    print >> out, "%s%s%s%s%s%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
                                   str('%s'   % timestamp   ).rjust(20,' '),
                                   str('%.3f' % total_time  ).rjust(10,' '),
                                   str('%.3f' % p1_X_imp_net).rjust(10,' '),
@@ -387,6 +2253,609 @@ def impulse(data_dict):
                                   str('%.3f' % p2_Y_imp_net).rjust(10,' '),
                                   str('%.3f' % p2_Z_imp_net).rjust(10,' '))
     
+#--- A table of the results for each file, kept by column
+#    Rows are collected and written a batch at a time as CSV, JSON lines
+#    or a NumPy record array, or printed straight away as fixed width
+#    text.  A NumPy file is only complete once the table is closed.
+class SummaryTable(object):
+    
+    def __init__(self, output = None,      # File to write, or stdout if None
+                 format = 'text',          # One of SUMMARY_FORMATS
+                 show_weight = False,      # Print the weight for text
+                 name_size = 256,          # Longest file name for npy
+                 batch_rows = SUMMARY_ROWS, # Rows to collect before writing
+                 fields = SUMMARY_FIELDS): # Columns of the table
+        self.output = output
+        self.format = format
+        self.show_weight = show_weight
+        self.batch_rows = batch_rows
+        self.fields = [(name, 'S%d' % name_size) if name == 'filename' else (name, dtype)
+                       for name, dtype in fields]
+        self.names = [name for name, dtype in self.fields]
+        self.columns = dict((name, []) for name in self.names)
+        self.rows = 0
+        self.written = 0
+        
+        #--- The records of a NumPy file are written first and the
+        #    header is put in front of them once the length is known
+        if output is None:
+            self.file = sys.stdout
+        elif format == 'npy':
+            self.file = open(output + '.rows', 'wb')
+        else:
+            self.file = open(output, 'wb')
+        
+        if format == 'text':
+            if show_weight:
+                weight_header(self.file)
+            else:
+                impulse_header(self.file)
+        elif format == 'csv':
+            self.writer = csv.writer(self.file, lineterminator = '\n')
+            self.writer.writerow(self.names)
+    
+    def append(self, data_dict): # Results for one file
+        
+        #--- Text is printed straight away so it can be watched
+        if self.format == 'text':
+            if self.show_weight:
+                weight(data_dict, self.file)
+            else:
+                impulse(data_dict, self.file)
+            return
+        
+        #--- The weight is not known for a file without any frames, so
+        #    missing values are kept as NaN until the rows are written
+        for name, dtype in self.fields:
+            if dtype == 'f8':
+                self.columns[name].append(data_dict.get(name, numpy.nan))
+            else:
+                self.columns[name].append(data_dict[name])
+        self.rows += 1
+        if self.rows >= self.batch_rows:
+            self.flush()
+    
+    def flush(self):
+        
+        if not self.rows:
+            self.file.flush()
+            return
+        
+        #--- Put the columns into a record array and write it at once
+        table = numpy.zeros(self.rows, dtype = self.fields)
+        for name in self.names:
+            table[name] = self.columns[name]
+            self.columns[name] = []
+        
+        #--- Missing and non-finite values are written as null in JSON and
+        #    as an empty cell in CSV, since neither format has NaN
+        if self.format in ('csv', 'json'):
+            rows = [[None if isinstance(value, float) and not numpy.isfinite(value) else value
+                     for value in row] for row in table.tolist()]
+        
+        if self.format == 'csv':
+            self.writer.writerows(rows)
+        elif self.format == 'json':
+            self.file.write(''.join([json.dumps(collections.OrderedDict(zip(self.names, row)),
+                                                allow_nan = False) + '\n'
+                                     for row in rows]))
+        elif self.format == 'npy':
+            self.file.write(table.tostring())
+        self.file.flush()
+        
+        self.written += self.rows
+        self.rows = 0
+    
+    def close(self):
+        
+        self.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+        
+        #--- Write the header for the records and move the whole file
+        #    into place so that it is never seen half written
+        if self.format == 'npy':
+            rows_path = self.output + '.rows'
+            tmp_path = self.output + '.tmp'
+            out = open(tmp_path, 'wb')
+            header = {'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(self.fields)),
+                      'fortran_order': False,
+                      'shape': (self.written,)}
+            numpy.lib.format.write_array_header_1_0(out, header)
+            rows = open(rows_path, 'rb')
+            shutil.copyfileobj(rows, out)
+            rows.close()
+            out.close()
+            os.rename(tmp_path, self.output)
+            os.remove(rows_path)
+
+#--- Print the time and memory used in each stage
+#    The stages are sorted with the slowest first
+def timings_header(out = None):
+    """This is the header for timing information"""
+    print >> out, "#%s%s%s%s%s%s" % (str('File'       ).rjust(14,' '),
+                                    str('Stage'      ).rjust(14,' '),
+                                    str('Calls'      ).rjust(8,' '),
+                                    str('Time (s)'   ).rjust(10,' '),
+                                    str('Memory (MB)').rjust(12,' '),
+                                    str('Peak (MB)'  ).rjust(10,' '))
+
+def timings(name, totals, out = None):
+    """A method to print the time and memory used in each stage"""
+    
+    stages = sorted(totals.items(), key = lambda item: -item[1]['time'])
+    for stage, total in stages:
+        print >> out, "%s%s%s%s%s%s" % (str('%s'   % name            ).rjust(15,' '),
+                                        str('%s'   % stage           ).rjust(14,' '),
+                                        str('%d'   % total['calls']  ).rjust(8,' '),
+                                        str('%.4f' % total['time']   ).rjust(10,' '),
+                                        str('%.1f' % total['memory'] ).rjust(12,' '),
+                                        str('%.1f' % total['peak']   ).rjust(10,' '))
+
+#--- Add the stage totals of one run to those of another
+def addTimings(totals, more):
+    for stage, total in more.items():
+        if stage not in totals:
+            totals[stage] = {'calls': 0, 'time': 0.0, 'memory': 0.0, 'peak': 0.0}
+        for key, value in total.items():
+            totals[stage][key] += value
+    return totals
+
+#--- Print the dominant frequency of each channel of a file
+def spectrum_header():
+    """This is the header for spectrum information"""
+    print "#%s%s%s%s%s%s%s" % (str('File'     ).rjust(14,' '),
+                              str('P1 X (Hz)').rjust(10,' '),
+                              str('P1 Y (Hz)').rjust(10,' '),
+                              str('P1 Z (Hz)').rjust(10,' '),
+                              str('P2 X (Hz)').rjust(10,' '),
+                              str('P2 Y (Hz)').rjust(10,' '),
+                              str('P2 Z (Hz)').rjust(10,' '))
+
+def spectrum(data_dict):
+    """A method to print the dominant frequency of each channel"""
+    
+    filename = data_dict['filename']
+    print "%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
+                    ''.join([str('%.2f' % data_dict.get('%s_peak_freq' % channel, numpy.nan)).rjust(10,' ')
+                             for channel in CHANNELS]))
+
+#--- Print the net impulse in each window of a file
+def windows_header():
+    """This is the header for impulse information in windows"""
+    print "#%s%s%s%s%s%s%s%s%s" % (str('File'     ).rjust(14,' '),
+                                  str('Start'    ).rjust(10,' '),
+                                  str('End'      ).rjust(10,' '),
+                                  str('P1 X (Ns)').rjust(10,' '),
+                                  str('P1 Y (Ns)').rjust(10,' '),
+                                  str('P1 Z (Ns)').rjust(10,' '),
+                                  str('P2 X (Ns)').rjust(10,' '),
+                                  str('P2 Y (Ns)').rjust(10,' '),
+                                  str('P2 Z (Ns)').rjust(10,' '))
+
+def windows(data_dict):
+    """A method to print the impulse found in each window"""
+    
+    filename = data_dict['filename']
+    for window, imp_net in zip(data_dict['windows'], data_dict['window_imp_net']):
+        print "%s%s%s%s" % (str('%s' % os.path.basename(filename)).rjust(15,' '),
+                            str('%d' % window[0]).rjust(10,' '),
+                            str('%d' % window[1]).rjust(10,' '),
+                            ''.join([str('%.3f' % value).rjust(10,' ') for value in imp_net]))
+
+#--- Read the windows given on the command line or in a file
+#    Windows on the command line look like "start:end,start:end"
+#    and a file has a start and end frame on each line
+def readWindows(windows = None,      # Windows from the command line
+                windows_file = None): # File of windows
+    pairs = []
+    if windows:
+        for window in windows.split(','):
+            start, end = window.split(':')
+            pairs.append((int(start), int(end)))
+    if windows_file:
+        pairs.extend(numpy.loadtxt(windows_file, dtype=int, ndmin=2).tolist())
+    return pairs
+
+#--- Check a file before it is parsed
+#    The records are counted and checked against the header and the frame
+#    range without decoding any of them.  Returns the file name, the
+#    number of records and the reason the file cannot be used, or None.
+def scanFile(task): # Tuple of (filename, frame range)
+    
+    filename, range = task
+    
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        try:
+            header, timestamp, scan_rate, total_scans, trigger_state, records = \
+                countRecords(filename)
+            checkRecords(records, total_scans)
+            frameRange(range, records)
+        except SystemExit:
+            return filename, records, sys.stdout.getvalue().strip()
+        except (IOError, OSError, ValueError), error:
+            return filename, None, str(error)
+    finally:
+        sys.stdout = stdout
+    
+    return filename, records, None
+
+#--- Process a single file for the batch
+#    This is run in a worker process when processing files in parallel,
+#    so anything the file prints is captured and any error is returned
+#    instead of stopping the rest of the batch.  If plot keywords are
+#    given the plates are drawn to files without a display here too, so
+#    the data does not have to be sent back to be plotted.  If timing is
+#    asked for the time in each stage is sent back as 'timings', with any
+#    time outside of the stages as 'other'.
+def processFile(task): # Tuple of (parse function, filename, keywords,
+                       #           keep data, plot keywords, timing)
+    
+    parse, filename, kwargs, keep_data, plot_kwargs, timed = task
+    
+    #--- Keep the totals of anything timed before this file separate
+    timers.enabled = timed
+    outer = timers.reset()
+    start = time.time()
+    
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        try:
+            data_dict = parse(filename, **kwargs)
+            if plot_kwargs is not None:
+                plot_plates(data_dict, headless = True, **plot_kwargs)
+        except SystemExit:
+            return filename, None, sys.stdout.getvalue().strip()
+        except Exception, error:
+            message = traceback.format_exception_only(type(error), error)
+            return filename, None, ''.join(message).strip()
+    finally:
+        sys.stdout = stdout
+        totals = timers.reset()
+        timers.totals = outer
+    
+    if timed:
+        other = time.time() - start - sum([total['time'] for total in totals.values()])
+        totals['other'] = {'calls': 1, 'time': other, 'memory': 0.0, 'peak': 0.0}
+        data_dict['timings'] = totals
+    
+    #--- Only send back the arrays if they are going to be plotted
+    if not keep_data and isinstance(data_dict, KDATrial):
+        data_dict = data_dict.summary()
+    
+    return filename, data_dict, None
+
+#--- A store of the results for each file that has been processed
+#    Results are keyed by a hash of the file's contents, the parsing
+#    function and its options, and the calibration matrix (which also
+#    covers the reversal), so a result is only used again when all of
+#    them are the same.  The hash of each file is kept with its size and
+#    modification time so that unchanged files are not read to hash them.
+class ResultsStore(object):
+    
+    #--- Options that change where the data comes from but not the results
+    IGNORED = ['cache_dir', 'rebuild_cache', 'cache_size', 'cache_hash']
+    
+    def __init__(self, path): # Name of the store file
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                                       filename TEXT PRIMARY KEY,
+                                       size INTEGER,
+                                       mtime REAL,
+                                       sha TEXT)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                       key TEXT PRIMARY KEY,
+                                       summary BLOB,
+                                       created REAL)""")
+    
+    def contentHash(self, filename): # Name of the file to hash
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        row = self.connection.execute("SELECT size, mtime, sha FROM hashes WHERE filename = ?",
+                                      (path,)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime):
+            return row[2]
+        sha = fileHash(filename)
+        self.connection.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)",
+                                (path, stat.st_size, stat.st_mtime, sha))
+        return sha
+    
+    def key(self, filename, parse, kwargs): # File, parsing function and its options
+        options = sorted([(name, value) for name, value in kwargs.items()
+                          if name not in self.IGNORED])
+        header = readHeader(filename)[0]
+        matrix = fileCalibration(filename, header,
+                                 kwargs.get('calibration_file'),
+                                 kwargs.get('profile'))[1]
+        key = hashlib.sha1(self.contentHash(filename))
+        key.update(parse.__name__)
+        key.update(repr(options))
+        key.update(numpy.asarray(matrix, dtype=float).tostring())
+        return key.hexdigest()
+    
+    def load(self, key, filename): # Key from key() and the file's name now
+        row = self.connection.execute("SELECT summary FROM results WHERE key = ?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        data_dict = cPickle.loads(str(row[0]))
+        
+        #--- Mark the result as recently used so it is kept
+        self.connection.execute("UPDATE results SET created = ? WHERE key = ?",
+                                (time.time(), key))
+        
+        #--- The same contents may have been stored under another name
+        data_dict['filename'] = filename
+        data_dict['title'] = os.path.basename(filename).split('.')[0]
+        data_dict['identifier'] = '%s_%s' % (data_dict['title'], data_dict['timestamp'])
+        return data_dict
+    
+    def save(self, key, data_dict): # Key from key() and the results to keep
+        data_dict = dict(data_dict)
+        for name in ('align', 'timings'):
+            data_dict.pop(name, None)
+        summary = cPickle.dumps(data_dict, cPickle.HIGHEST_PROTOCOL)
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?,?,?)",
+                                (key, sqlite3.Binary(summary), time.time()))
+    
+    def close(self,
+              rows = STORE_ROWS): # Most results to keep
+        
+        #--- Drop the least recently used results and the oldest hashes
+        #    so that the store does not grow without bound
+        self.connection.execute("""DELETE FROM results WHERE key NOT IN
+                                       (SELECT key FROM results
+                                        ORDER BY created DESC LIMIT ?)""", (rows,))
+        self.connection.execute("""DELETE FROM hashes WHERE rowid NOT IN
+                                       (SELECT rowid FROM hashes
+                                        ORDER BY rowid DESC LIMIT ?)""", (rows,))
+        self.connection.commit()
+        self.connection.close()
+
+#--- Send back the stored results for each file in order, along with the
+#    results of the files that had to be processed
+def mergeResults(file_list, # Files in the order their results are needed
+                 stored,    # Dictionary of stored results for some files
+                 results):  # Results from processFile for the other files
+    for file in file_list:
+        if file in stored:
+            yield file, stored[file], None
+        else:
+            yield results.next()
+
+#--- Plots are described as a list of figures, where each figure is a
+#    dictionary with the file name to save it as, its title and labels,
+#    and a list of (x, y, format, label) lines.  The same figures can
+#    then be shown with pylab or drawn without a display.
+
+#--- A function to reduce a series to the lowest and highest point in
+#    each of a number of buckets, so a plot keeps all of its peaks while
+#    only drawing a few points for each pixel.  The first and last points
+#    are always kept so the plot covers the same range.
+def decimateMinMax(x,       # Values for the x-axis, in increasing order
+                   y,       # Values for the y-axis
+                   buckets): # Number of buckets to reduce the series to
+    
+    samples = len(y)
+    if buckets < 1 or samples <= 2*buckets + 2:
+        return x, y
+    
+    #--- Put the points into equal buckets, repeating the last point to
+    #    fill up the last bucket
+    size = int(numpy.ceil(samples / float(buckets)))
+    buckets = int(numpy.ceil(samples / float(size)))
+    index = numpy.minimum(numpy.arange(buckets*size), samples - 1).reshape(buckets, size)
+    values = y[index]
+    
+    #--- Keep the lowest and highest point in each bucket in order
+    #    Missing (NaN) points are only kept if the whole bucket is missing,
+    #    so gaps in a series are still drawn as gaps
+    rows = numpy.arange(buckets)
+    missing = numpy.isnan(values)
+    low = index[rows, numpy.where(missing, numpy.inf, values).argmin(axis = 1)]
+    high = index[rows, numpy.where(missing, -numpy.inf, values).argmax(axis = 1)]
+    keep = numpy.concatenate(([0], low, high, [samples - 1]))
+    keep = numpy.unique(keep)
+    
+    return x[keep], y[keep]
+
+#--- Plot a series reduced to a min and max for each horizontal pixel
+#    When the x-axis limits change, for example when zooming or panning,
+#    the visible part of the full series is reduced again so detail is
+#    never lost.
+def plot_decimated(axes,   # The axes to draw on
+                   x,      # Values for the x-axis, in increasing order
+                   y,      # Values for the y-axis
+                   format, # Line format
+                   label): # Label for the legend
+    
+    def pixels():
+        return max(int(axes.get_window_extent().width), 1)
+    
+    line, = axes.plot(*decimateMinMax(x, y, pixels()) + (format,), label=label)
+    
+    def update(axes):
+        xmin, xmax = sorted(axes.get_xlim())
+        start = max(numpy.searchsorted(x, xmin) - 1, 0)
+        end = numpy.searchsorted(x, xmax) + 1
+        line.set_data(*decimateMinMax(x[start:end], y[start:end], pixels()))
+    axes.callbacks.connect('xlim_changed', update)
+    
+    return line
+
+#--- Draw many lines as a single collection, which is much faster than
+#    drawing each line on its own.  Only the colors of the line formats
+#    are used.  Returns a line for each label to use in the legend.
+def plot_collection_lines(axes,            # The axes to draw on
+                          lines,           # List of (x, y, format, label)
+                          decimate = True): # Only draw a min and max for each pixel
+    
+    def pixels():
+        return max(int(axes.get_window_extent().width), 1)
+    
+    #--- Build a segment for each line, only using the visible part of
+    #    each line when limits are given
+    def segments(limits = None):
+        segment_list = []
+        for x, y, format, label in lines:
+            if limits is not None:
+                start = max(numpy.searchsorted(x, limits[0]) - 1, 0)
+                end = numpy.searchsorted(x, limits[1]) + 1
+                x, y = x[start:end], y[start:end]
+            if decimate:
+                x, y = decimateMinMax(x, y, pixels())
+            segment_list.append(numpy.column_stack((x, y)))
+        return segment_list
+    
+    colors = [matplotlib.colors.colorConverter.to_rgba(format.strip('-.'))
+              for x, y, format, label in lines]
+    collection = matplotlib.collections.LineCollection(segments(), colors=colors)
+    axes.add_collection(collection)
+    axes.autoscale_view()
+    
+    #--- Build the visible segments again when the view changes
+    if decimate:
+        def update(axes):
+            collection.set_segments(segments(sorted(axes.get_xlim())))
+        axes.callbacks.connect('xlim_changed', update)
+    
+    return [matplotlib.lines.Line2D([], [], color=color, label=label)
+            for color, (x, y, format, label) in zip(colors, lines)]
+
+#--- Draw a figure onto a set of axes
+def draw_figure(axes,           # The axes to draw on
+                figure,         # The figure to draw
+                t_range = None, # The time range to set for plots
+                decimate = True): # Only draw a min and max for each pixel
+    if figure.get('collection'):
+        handles = plot_collection_lines(axes, figure['lines'], decimate)
+    else:
+        for x, y, format, label in figure['lines']:
+            if decimate:
+                plot_decimated(axes, x, y, format, label)
+            else:
+                axes.plot(x, y, format, label=label)
+        handles, labels = axes.get_legend_handles_labels()
+    if t_range:
+        axes.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
+    if figure.get('yscale'):
+        axes.set_yscale(figure['yscale'])
+    axes.legend(handles=handles, loc='best')
+    axes.set_xlabel(figure['xlabel'])
+    axes.set_ylabel(figure['ylabel'])
+    axes.set_title(figure['title'])
+    axes.grid(True)
+
+#--- Draw a figure and save it to a file without using a display
+#    This uses the Agg backend and the Figure object directly, so the
+#    figure is not kept by pylab and is freed once it has been saved
+def render_figure(task): # Tuple of (figure, time range, decimate)
+    figure, t_range, decimate = task
+    with timers.stage('draw'):
+        fig = matplotlib.figure.Figure()
+        matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        draw_figure(fig.add_subplot(111), figure, t_range, decimate)
+        fig.savefig(figure['name'])
+    return figure['name']
+
+#--- Draw a list of figures without a display, in a pool of processes
+#    if more than one job is requested
+def render_figures(figures,        # List of figures to draw
+                   t_range = None, # The time range to set for plots
+                   jobs = 1,       # Number of processes to draw with
+                   decimate = True): # Only draw a min and max for each pixel
+    tasks = [(figure, t_range, decimate) for figure in figures]
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        names = pool.map(render_figure, tasks)
+        pool.close()
+        pool.join()
+        return names
+    return map(render_figure, tasks)
+
+#--- Show a list of figures with pylab, saving them if requested
+def show_figures(figures,           # List of figures to show
+                 t_range = None,    # The time range to set for plots
+                 save_plot = False, # Save plots at *.png files to working dir
+                 decimate = True):  # Only draw a min and max for each pixel
+    for figure in figures:
+        with timers.stage('draw'):
+            fig = pylab.figure()
+            draw_figure(fig.gca(), figure, t_range, decimate)
+            
+            #--- Save the plot if requested
+            #    Saving from the figure itself avoids pylab drawing it again
+            if save_plot:
+                fig.savefig(figure['name'])
+
+def plate_figures(data_dict,
+                  inspect = False,      # Inspect the graphs by frame number
+                  plate_1 = False,      # Plot plate 1 forces
+                  plate_2 = False,      # Plot plate 2 forces
+                  x_plot = False,       # Plot forces in x-axis
+                  y_plot = False,       # Plot forces in y-axis
+                  z_plot = False,       # Plot forces in z-axis
+                  cop_plot = False):    # Plot the center of pressure
+    """
+    This method describes the figures for plot_plates.
+    """
+    
+    #--- If inspecting the frames set the time field to the frame number
+    time = data_dict['time']
+    if inspect:
+        time = data_dict['frame']
+    
+    title = data_dict['title']
+    timestamp = data_dict['timestamp']
+    identifier = data_dict['identifier']
+    
+    figures = []
+    def add_figure(name, plot_title, lines, ylabel = 'Force (N)'):
+        figures.append({'name': '%s_%s' % (identifier, name),
+                        'title': '%s, %s\n%s' % (title, timestamp, plot_title),
+                        'xlabel': 'Time (s)',
+                        'ylabel': ylabel,
+                        'lines': lines})
+    
+    #--- Make plots of the force on each plate
+    if plate_1:
+        add_figure('plot_p1', 'Plate 1 Force Plot',
+                   [(time, data_dict['p1_X'], '.-b', 'X-axis'),
+                    (time, data_dict['p1_Y'], '.-g', 'Y-axis'),
+                    (time, data_dict['p1_Z'], '.-r', 'Z-axis')])
+    
+    if plate_2:
+        add_figure('plot_p2', 'Plate 2 Force Plot',
+                   [(time, data_dict['p2_X'], '.-b', 'X-axis'),
+                    (time, data_dict['p2_Y'], '.-g', 'Y-axis'),
+                    (time, data_dict['p2_Z'], '.-r', 'Z-axis')])
+    
+    #--- Make plots of the force on both plates for each axis
+    for axis, do_axis in (('x', x_plot), ('y', y_plot), ('z', z_plot)):
+        if do_axis:
+            add_figure('plot_%s' % axis, '%s-axis Force Plot' % axis.upper(),
+                       [(time, data_dict['p1_%s' % axis.upper()], '.-b', 'Plate 1'),
+                        (time, data_dict['p2_%s' % axis.upper()], '.-r', 'Plate 2')])
+    
+    #--- Make plots of the center of pressure on each chosen plate
+    if cop_plot and 'p1_COP_X' in data_dict:
+        for plate, do_plate in (('1', plate_1), ('2', plate_2)):
+            if do_plate:
+                add_figure('plot_p%s_cop' % plate, 'Plate %s Center of Pressure Plot' % plate,
+                           [(time, data_dict['p%s_COP_X' % plate], '.-b', 'X-axis'),
+                            (time, data_dict['p%s_COP_Y' % plate], '.-g', 'Y-axis')],
+                           ylabel = 'Position (m)')
+    
+    return figures
+
 def plot_plates(data_dict,
                 inspect = False,      # Inspect the graphs by frame number
                 t_range = None,       # The time range to set for plots
@@ -395,115 +2864,113 @@ def plot_plates(data_dict,
                 x_plot = False,       # Plot forces in x-axis
                 y_plot = False,       # Plot forces in y-axis
                 z_plot = False,       # Plot forces in z-axis
-                save_plot = False):   # Save plots at *.png files to working dir
+                cop_plot = False,     # Plot the center of pressure
+                save_plot = False,    # Save plots at *.png files to working dir
+                headless = False,     # Save plots without using a display
+                decimate = True):     # Only draw a min and max for each pixel
     """
     This method is useful for plotting all the XYZ-axis data for a single
     plate on one graph.  This method will also print all the plate data,
     Plate 1 and Plate 2, for a single axis (X, Y or Z) on a single graph.
     """
     
-    #--- If inspecting the frames set the time field to the frame number
-    time = data_dict['time']
-    if inspect:
-        time = data_dict['frame']
+    with timers.stage('figures'):
+        figures = plate_figures(data_dict,
+                                inspect = inspect,
+                                plate_1 = plate_1,
+                                plate_2 = plate_2,
+                                x_plot = x_plot,
+                                y_plot = y_plot,
+                                z_plot = z_plot,
+                                cop_plot = cop_plot)
     
-    title = data_dict['title']
-    timestamp = data_dict['timestamp']
-    identifier = data_dict['identifier']
-    p1_X = data_dict['p1_X']
-    p1_Y = data_dict['p1_Y']
-    p1_Z = data_dict['p1_Z']
-    p2_X = data_dict['p2_X']
-    p2_Y = data_dict['p2_Y']
-    p2_Z = data_dict['p2_Z']
+    if headless:
+        render_figures(figures, t_range, decimate = decimate)
+    else:
+        show_figures(figures, t_range, save_plot, decimate)
+
+def collection_figures(file_dict = {},       # The dictionary of file names and data
+                       inspect = False,      # Inspect the graphs by frame number
+                       plate_1 = False,      # Plot plate 1 forces
+                       plate_2 = False,      # Plot plate 2 forces
+                       mag_plot = False,     # Plot the magnitude of the forces
+                       x_plot = False,       # Plot forces in x-axis
+                       y_plot = False,       # Plot forces in y-axis
+                       z_plot = False,       # Plot forces in z-axis
+                       cop_plot = False):    # Plot the center of pressure
+    """
+    This method describes the figures for plot_collection.
+    """
+
+    #--- Get a list of all the file names
+    file_names = file_dict.keys()
+    file_names.sort()
     
-    #--- Make plots of the force on each plate
+    #--- These are the available colors we can use for the plot lines
+    #    The program will cycle through them to make reading the graphs easier
+    color_list = ['b','g','r','c','m','y','k']
+    
+    #--- Create a list of plates to graph
+    plate_list = []
     if plate_1:
-        pylab.figure()
-        pylab.plot(time, p1_X, '.-b', label='X-axis')
-        pylab.plot(time, p1_Y, '.-g', label='Y-axis')
-        pylab.plot(time, p1_Z, '.-r', label='Z-axis')
-        if t_range:
-            pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-        pylab.legend(loc='best')
-        pylab.xlabel('Time (s)')
-        pylab.ylabel('Force (N)')
-        pylab.title('%s, %s\nPlate 1 Force Plot' % (title, timestamp))
-        pylab.grid(True)
-        
-        #--- Save the plot if requested
-        if save_plot:
-            figure_name = '%s_plot_p1' % (identifier)
-            pylab.savefig(figure_name)
-            
+        plate_list.append('1')
     if plate_2:
-        pylab.figure()
-        pylab.plot(time, p2_X, '.-b', label='X-axis')
-        pylab.plot(time, p2_Y, '.-g', label='Y-axis')
-        pylab.plot(time, p2_Z, '.-r', label='Z-axis')
-        if t_range:
-            pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-        pylab.legend(loc='best')
-        pylab.xlabel('Time (s)')
-        pylab.ylabel('Force (N)')
-        pylab.title('%s, %s\nPlate 2 Force Plot' % (title, timestamp))
-        pylab.grid(True)
-        
-        #--- Save the plot if requested
-        if save_plot:
-            figure_name = '%s_plot_p2' % (identifier)
-            pylab.savefig(figure_name)
-    
-    if x_plot:
-        pylab.figure()
-        pylab.plot(time, p1_X, '.-b', label='Plate 1')
-        pylab.plot(time, p2_X, '.-r', label='Plate 2')
-        if t_range:
-            pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-        pylab.legend(loc='best')
-        pylab.xlabel('Time (s)')
-        pylab.ylabel('Force (N)')
-        pylab.title('%s, %s\nX-axis Force Plot' % (title, timestamp))
-        pylab.grid(True)
-        
-        #--- Save the plot if requested
-        if save_plot:
-            figure_name = '%s_plot_x' % (identifier)
-            pylab.savefig(figure_name)
-        
-    if y_plot:
-        pylab.figure()
-        pylab.plot(time, p1_Y, '.-b', label='Plate 1')
-        pylab.plot(time, p2_Y, '.-r', label='Plate 2')
-        if t_range:
-            pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-        pylab.legend(loc='best')
-        pylab.xlabel('Time (s)')
-        pylab.ylabel('Force (N)')
-        pylab.title('%s, %s\nY-axis Force Plot' % (title, timestamp))
-        pylab.grid(True)
-        
-        #--- Save the plot if requested
-        if save_plot:
-            figure_name = '%s_plot_y' % (identifier)
-            pylab.savefig(figure_name)
-        
-    if z_plot:
-        pylab.figure()
-        pylab.plot(time, p1_Z, '.-b', label='Plate 1')
-        pylab.plot(time, p2_Z, '.-r', label='Plate 2')
-        if t_range:
-            pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-        pylab.legend(loc='best')
-        pylab.xlabel('Time (s)')
-        pylab.ylabel('Force (N)')
-        pylab.title('%s, %s\nZ-axis Force Plot' % (title, timestamp))
-        pylab.grid(True)
-        
-        #--- Save the plot if requested
-        if save_plot:
-            figure_name = '%s_plot_z' % (identifier)
-            pylab.savefig(figure_name)
+        plate_list.append('2')
+    
+    #--- The options given determine the dataset to choose from
+    #    for the magnitude plot
+    axis = ''
+    for name, do_axis in (('X', x_plot), ('Y', y_plot), ('Z', z_plot)):
+        if do_axis:
+            axis += name
+    
+    #--- Make a list of the data to plot on each figure
+    #    Check that the required set of axis are given for the magnitude
+    series_list = []
+    for name, do_axis in (('X', x_plot), ('Y', y_plot), ('Z', z_plot)):
+        if do_axis:
+            series_list.append((name, '%s-axis Force Plot' % name, 'plot_%s' % name.lower(), 'Force (N)'))
+    if mag_plot and len(axis) >= 2:
+        series_list.append(('%s_mag' % axis, '%s-axis Magnitude Force Plot' % axis, '%s_mag_plot' % axis, 'Force (N)'))
+    if cop_plot:
+        for name in ('X', 'Y'):
+            series_list.append(('COP_%s' % name, '%s-axis Center of Pressure Plot' % name,
+                                'plot_cop_%s' % name.lower(), 'Position (m)'))
+    
+    #--- Set up every figure for each plate in the list
+    #    The lines on each figure are drawn together as one collection
+    figures = []
+    for plate in plate_list:
+        for series, plot_title, name, ylabel in series_list:
+            figures.append({'name': 'plate_%s_%s' % (plate,name),
+                            'title': '%s Plate %s' % (plot_title,plate),
+                            'xlabel': 'Time (s)',
+                            'ylabel': ylabel,
+                            'collection': True,
+                            'key': 'p%s_%s' % (plate,series),
+                            'lines': []})
+    
+    #--- Go through the files once, adding each file to every figure
+    count = 0
+    for file in file_names:
+        
+        color = color_list[count]
+        
+        #--- If inspecting the frames set the time field to the frame number
+        #    This is only worked out once for each file
+        if inspect:
+            time = file_dict[file]['frame'] - file_dict[file]['align']
+        else:
+            time = file_dict[file]['time'] - file_dict[file]['delta_t'] * file_dict[file]['align']
+        
+        label = file_dict[file]['title']
+        for figure in figures:
+            figure['lines'].append((time, file_dict[file][figure['key']], '-%s' % (color), label))
+        count += 1
+        if count >= len(color_list):
+            count = 0
+    
+    return figures
 
 #--- Plot the collection of plots
 def plot_collection(file_dict = {},       # The dictionary of file names and data
@@ -515,168 +2982,99 @@ def plot_collection(file_dict = {},       # The dictionary of file names and dat
                     x_plot = False,       # Plot forces in x-axis
                     y_plot = False,       # Plot forces in y-axis
                     z_plot = False,       # Plot forces in z-axis)
-                    save_plot = False):   # Save plots at *.png files to working dir
+                    cop_plot = False,     # Plot the center of pressure
+                    save_plot = False,    # Save plots at *.png files to working dir
+                    headless = False,     # Save plots without using a display
+                    jobs = 1,             # Number of processes to draw with
+                    decimate = True):     # Only draw a min and max for each pixel
     """
     This method is used for plotting multiple collections of data separated
     by both axis and plate.  This means up to six graphs will be printed
     depending on options given with data from every file on each graph.
     """
+    
+    with timers.stage('figures'):
+        figures = collection_figures(file_dict = file_dict,
+                                     inspect = inspect,
+                                     plate_1 = plate_1,
+                                     plate_2 = plate_2,
+                                     mag_plot = mag_plot,
+                                     x_plot = x_plot,
+                                     y_plot = y_plot,
+                                     z_plot = z_plot,
+                                     cop_plot = cop_plot)
+    
+    if headless:
+        render_figures(figures, t_range, jobs, decimate)
+    else:
+        show_figures(figures, t_range, save_plot, decimate)
 
-    #--- Get a list of all the file names
-    file_names = file_dict.keys()
-    file_names.sort()
+def spectrum_figures(file_dict = {},       # The dictionary of file names and data
+                     plate_1 = False,      # Plot plate 1 spectra
+                     plate_2 = False,      # Plot plate 2 spectra
+                     x_plot = False,       # Plot spectra in x-axis
+                     y_plot = False,       # Plot spectra in y-axis
+                     z_plot = False):      # Plot spectra in z-axis
+    """
+    This method describes a figure of the power spectral density of
+    each chosen plate and axis, with a line for every file.
+    """
     
     #--- These are the available colors we can use for the plot lines
-    #    The program will cycle through them to make reading the graphs easier
     color_list = ['b','g','r','c','m','y','k']
     
-    #--- Create a list of plates to graph
-    plate_list = []
-    if plate_1:
-        plate_list.append('1')
-    if plate_2:
-        plate_list.append('2')
-        
-    #--- Loop through each plate in the list
-    for plate in plate_list:
-        
-        if x_plot:
-            pylab.figure()
-            count = 0
-            for file in file_names:
-                
-                color = color_list[count]
-                
-                #--- If inspecting the frames set the time field to the frame number
-                time = file_dict[file]['time'] - file_dict[file]['delta_t'] * file_dict[file]['align']
-                if inspect:
-                    time = file_dict[file]['frame'] - file_dict[file]['align']
-                
-                label = file_dict[file]['title']
-                pylab.plot(time, file_dict[file]['p%s_X' % plate], '-%s' % (color) , label=label)
-                count += 1
-                if count >= len(color_list):
-                    count = 0
-            
-            if t_range:
-                pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-            pylab.legend(loc='best')
-            pylab.xlabel('Time (s)')
-            pylab.ylabel('Force (N)')
-            pylab.title('X-axis Force Plot Plate %s' % (plate))
-            pylab.grid(True)
-            
-            #--- Save the plot if requested
-            if save_plot:
-                figure_name = 'plate_%s_plot_x' % (plate)
-                pylab.savefig(figure_name)
-            
-        if y_plot:
-            pylab.figure()
-            count = 0
-            for file in file_names:
-                
-                color = color_list[count]
-                
-                #--- If inspecting the frames set the time field to the frame number
-                time = file_dict[file]['time'] - file_dict[file]['delta_t'] * file_dict[file]['align']
-                if inspect:
-                    time = file_dict[file]['frame'] - file_dict[file]['align']
-                
-                label = file_dict[file]['title']
-                pylab.plot(time, file_dict[file]['p%s_Y' % plate], '-%s' % (color) , label=label)
-                count += 1
-                if count >= len(color_list):
-                    count = 0
-            
-            if t_range:
-                pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-            pylab.legend(loc='best')
-            pylab.xlabel('Time (s)')
-            pylab.ylabel('Force (N)')
-            pylab.title('Y-axis Force Plot Plate %s' % (plate))
-            pylab.grid(True)
-            
-            #--- Save the plot if requested
-            if save_plot:
-                figure_name = 'plate_%s_plot_y' % (plate)
-                pylab.savefig(figure_name)
-            
-        if z_plot:
-            pylab.figure()
-            count = 0
-            for file in file_names:
-                
-                color = color_list[count]
-                
-                #--- If inspecting the frames set the time field to the frame number
-                time = file_dict[file]['time'] - file_dict[file]['delta_t'] * file_dict[file]['align']
-                if inspect:
-                    time = file_dict[file]['frame'] - file_dict[file]['align']
-                    
-                label = file_dict[file]['title']
-                pylab.plot(time, file_dict[file]['p%s_Z' % plate], '-%s' % (color) , label=label)
-                count += 1
-                if count >= len(color_list):
-                    count = 0
-            
-            if t_range:
-                pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-            pylab.legend(loc='best')
-            pylab.xlabel('Time (s)')
-            pylab.ylabel('Force (N)')
-            pylab.title('Z-axis Force Plot Plate %s' % (plate))
-            pylab.grid(True)
-            
-            #--- Save the plot if requested
-            if save_plot:
-                figure_name = 'plate_%s_plot_z' % (plate)
-                pylab.savefig(figure_name)
-        
-        #--- Check that the required set of axis are given
-        do_plot_mag = (options.x_plot and options.y_plot)
-        do_plot_mag = do_plot_mag or (options.x_plot and options.z_plot)
-        do_plot_mag = do_plot_mag or (options.y_plot and options.z_plot)
-        if mag_plot and do_plot_mag:
-            pylab.figure()
-            count = 0
-            for file in file_names:
-                
-                #--- The options given determine the dataset to choose from
-                if all([options.x_plot, options.y_plot, options.z_plot]):
-                    axis = 'XYZ'
-                elif all([options.x_plot, options.y_plot]):
-                    axis = 'XY'
-                elif all([options.x_plot, options.z_plot]):
-                    axis = 'XZ'
-                elif all([options.y_plot, options.z_plot]):
-                    axis = 'YZ'
-                
-                color = color_list[count]
-                
-                #--- If inspecting the frames set the time field to the frame number
-                time = file_dict[file]['time'] - file_dict[file]['delta_t'] * file_dict[file]['align']
-                if inspect:
-                    time = file_dict[file]['frame'] - file_dict[file]['align']
-                
-                label = file_dict[file]['title']
-                pylab.plot(time, file_dict[file]['p%s_%s_mag' % (plate,axis)], '-%s' % (color) , label=label)
-                count += 1
-                if count >= len(color_list):
-                    count = 0
-            
-            if t_range:
-                pylab.axis([t_range[0],t_range[1],t_range[2],t_range[3]])
-            pylab.legend(loc='best')
-            pylab.xlabel('Time (s)')
-            pylab.ylabel('Force (N)')
-            pylab.title('%s-axis Magnitude Force Plot Plate %s' % (axis,plate))
-            pylab.grid(True)
-            
-            #--- Save the plot if requested
-            if save_plot:
-                figure_name = 'plate_%s_%s_mag_plot' % (plate,axis)
-                pylab.savefig(figure_name)
+    files = sorted([file for file in file_dict if 'psd' in file_dict[file]])
+    prefix = 'collection'
+    if len(files) == 1:
+        prefix = file_dict[files[0]]['identifier']
+    
+    figures = []
+    for plate, do_plate in (('1', plate_1), ('2', plate_2)):
+        for axis, do_axis in (('X', x_plot), ('Y', y_plot), ('Z', z_plot)):
+            if not (do_plate and do_axis):
+                continue
+            channel = CHANNELS.index('p%s_%s' % (plate, axis))
+            lines = []
+            for index, file in enumerate(files):
+                data_dict = file_dict[file]
+                lines.append((data_dict['psd_freq'], data_dict['psd'][channel],
+                              '-%s' % color_list[index % len(color_list)],
+                              data_dict['title']))
+            figures.append({'name': '%s_spectrum_p%s_%s' % (prefix, plate, axis.lower()),
+                            'title': 'Plate %s %s-axis Power Spectral Density' % (plate, axis),
+                            'xlabel': 'Frequency (Hz)',
+                            'ylabel': 'PSD (N^2/Hz)',
+                            'yscale': 'log',
+                            'lines': lines})
+    return figures
+
+def plot_spectrum(file_dict = {},       # The dictionary of file names and data
+                  plate_1 = False,      # Plot plate 1 spectra
+                  plate_2 = False,      # Plot plate 2 spectra
+                  x_plot = False,       # Plot spectra in x-axis
+                  y_plot = False,       # Plot spectra in y-axis
+                  z_plot = False,       # Plot spectra in z-axis
+                  save_plot = False,    # Save plots at *.png files to working dir
+                  headless = False,     # Save plots without using a display
+                  jobs = 1,             # Number of processes to draw with
+                  decimate = True):     # Only draw a min and max for each pixel
+    """
+    This method is used for plotting the power spectral density of each
+    chosen plate and axis for every file.
+    """
+    
+    with timers.stage('figures'):
+        figures = spectrum_figures(file_dict = file_dict,
+                                   plate_1 = plate_1,
+                                   plate_2 = plate_2,
+                                   x_plot = x_plot,
+                                   y_plot = y_plot,
+                                   z_plot = z_plot)
+    
+    if headless:
+        render_figures(figures, None, jobs, decimate)
+    else:
+        show_figures(figures, None, save_plot, decimate)
 
 #--- Declare the program that will run
 if __name__ == '__main__':
@@ -689,27 +3087,124 @@ if __name__ == '__main__':
     p = optparse.OptionParser(usage,description=description)
     
     p.add_option('-a', action='store', type='string', dest='align',
-                 help='Frames numbers to use when aligning the data')
+                 help='Frames numbers to use when aligning the data (default: the first contact in each file)')
+    p.add_option('-b', '--batch', action="store_true", dest="batch", default=False,
+                 help='Find the impulse or weight for all the files at once after they are parsed')
     p.add_option('-c', action="store_true", dest="collect", default=False,
                  help='Plot forces in a collection')
+    p.add_option('--chunk-rows', action='store', type='int', dest='chunk_rows',
+                 default = CHUNK_ROWS, help='Number of rows to read at a time with --stream')
+    p.add_option('--calibration', action='store', type='string', dest='calibration_file',
+                 help='File of calibration profiles (default: %s in the directory of each file)' % CALIBRATION_FILE)
+    p.add_option('--cache-dir', action='store', type='string', dest='cache_dir',
+                 default = CACHE_DIR, help='Directory used to cache parsed KDA files')
+    p.add_option('--cache-hash', action="store_true", dest="cache_hash", default=False,
+                 help='Also check a hash of the file contents before using the cache')
+    p.add_option('--cache-size', action='store', type='float', dest='cache_size',
+                 default = CACHE_SIZE, help='Maximum size of the cache directory in MB')
+    p.add_option('--contact-on', action='store', type='float', dest='contact_on',
+                 default = CONTACT_ON, help='Z-axis force in N that starts a contact')
+    p.add_option('--contact-off', action='store', type='float', dest='contact_off',
+                 default = CONTACT_OFF, help='Z-axis force in N that ends a contact')
+    p.add_option('--contact-min', action='store', type='float', dest='contact_min',
+                 default = CONTACT_MIN, help='Shortest contact in seconds')
+    p.add_option('--cop', action="store_true", dest="cop_plot", default=False,
+                 help='Plot the center of pressure on each chosen plate (-p)')
+    p.add_option('--cop-force', action='store', type='float', dest='cop_force',
+                 default=COP_FORCE,
+                 help='Only find the center of pressure when the Z-axis force is above this in N (default %.1f)' % COP_FORCE)
+    p.add_option('--cprofile', action='store', type='string', dest='cprofile',
+                 help='Save cProfile statistics for the run to this file (use with -j 1)')
     p.add_option('-d', '--dir', action='store', type='string', dest='dirName',
                  default = '.', help='Directory containing KDA files with csv data to batch process')
+    p.add_option('--dtype', action='store', type='choice', dest='dtype',
+                 choices = DTYPES, default = DTYPES[0],
+                 help='Store the samples and forces as: %s (default %s)' % \
+                      (', '.join(DTYPES), DTYPES[0]))
+    p.add_option('-e', '--events', action="store_true", dest="events", default=False,
+                 help='Print the contacts found on each plate of each file')
+    p.add_option('--format', action='store', type='choice', dest='format',
+                 choices = SUMMARY_FORMATS,
+                 help='Format of the results: %s (default from the -o extension, or text)' % \
+                      ', '.join(SUMMARY_FORMATS))
+    p.add_option('--follow', action="store_true", dest="follow", default=False,
+                 help='Follow a file (-f) or the newest file in a directory (-d) while it is being written')
+    p.add_option('--follow-window', action='store', type='float', dest='follow_window',
+                 default = FOLLOW_WINDOW, help='Seconds of the latest data to plot with --follow')
+    p.add_option('--fps', action='store', type='float', dest='fps',
+                 default = FOLLOW_FPS, help='Most updates each second with --follow')
     p.add_option('-f','--file', action='store', type='string', dest='filename',
                  help='KDA File containing csv data')
+    p.add_option('-j', '--jobs', action="store", type='int', dest="jobs", default=1,
+                 help='Number of processes used to parse files (0 uses every CPU)')
+    p.add_option('--headless', action="store_true", dest="headless", default=False,
+                 help='Save plots without a display, drawing them in parallel with -j.  With a directory and no -c every file is plotted.')
+    p.add_option('--index', action="store_true", dest="index", default=False,
+                 help='Use an index of the files in the directory (-d) and everything under it')
+    p.add_option('--index-file', action='store', type='string', dest='index_file',
+                 help='Keep the index in this file (default: %s in the directory)' % INDEX_FILE)
     p.add_option('-i', action="store_true", dest="inspect", default=False,
                  help='Inspect the data by viewing plots with frame count instead of time on x-axis')
+    p.add_option('--manifest', action='store', type='string', dest='manifest',
+                 help='Save the valid and invalid files found by the scan to this JSON file')
+    p.add_option('--lowpass', action='store', type='float', dest='lowpass',
+                 help='Filter the forces with a zero phase Butterworth low-pass filter with this cutoff in Hz')
     p.add_option('-m', action="store_true", dest="mag_plot", default=False,
                  help='Plot force magnitude for both plates')
+    p.add_option('--no-cache', action="store_true", dest="no_cache", default=False,
+                 help='Do not read or write the cache of parsed KDA files')
+    p.add_option('--no-decimate', action="store_false", dest="decimate", default=True,
+                 help='Draw every sample instead of a min and max for each pixel')
+    p.add_option('--no-scan', action="store_false", dest="scan", default=True,
+                 help='Do not count the records in each file before parsing them')
+    p.add_option('--no-store', action="store_false", dest="store", default=True,
+                 help='Process every file again instead of using stored results for unchanged files')
+    p.add_option('--notch', action='store', type='float', dest='notch',
+                 help='Filter out this frequency in Hz (such as mains hum at 50 or 60) with a zero phase notch filter')
+    p.add_option('-o', '--output', action='store', type='string', dest='output',
+                 help='Write the results for each file to this file instead of printing them')
     p.add_option('-p', action="store", type='int', dest="plate",
                  help='Plot force in x and z for specified plate number (0 [both], 1 [plate 1] or 2 [plate 2])')
+    p.add_option('--profile', action='store', type='string', dest='profile',
+                 help='Name of the calibration profile to use (default: the file header, then "default")')
+    p.add_option('--rate', action='store', type='int', dest='rate',
+                 help='Resample every file to this scan rate in Hz before comparing, plotting or finding spectra')
+    p.add_option('--resample', action='store', type='choice', dest='resample',
+                 choices = RESAMPLE_METHODS, default = RESAMPLE_METHODS[0],
+                 help='Method used to resample with --rate: %s (default %s)' % \
+                      (', '.join(RESAMPLE_METHODS), RESAMPLE_METHODS[0]))
     p.add_option('-r', action="store", dest="range", nargs=2, default=(-1,-1),
                  help='Parse a range of data in the file between given frame numbers (start frame -> end frame)')
+    p.add_option('--rebuild-cache', action="store_true", dest="rebuild_cache", default=False,
+                 help='Parse every KDA file again and replace its cached copy')
     p.add_option('-s', action="store_true", dest="save_plot", default=False,
                  help='Save each requested plot to a file.  Plots save automatically when batch processing.')
+    p.add_option('--spectrum', action="store_true", dest="spectrum", default=False,
+                 help='Find the power spectral density of each channel and print the dominant frequencies. Plots the chosen plates (-p) and axes')
+    p.add_option('--spectrum-segment', action='store', type='float', dest='spectrum_segment',
+                 default = SPECTRUM_SEGMENT, help='Seconds of data in each segment of the power spectrum')
+    p.add_option('--stream', action="store_true", dest="stream", default=False,
+                 help='Find the impulse and weight a chunk at a time without keeping the data (no plots)')
+    p.add_option('--select', action='append', type='string', dest='select',
+                 help='Only use files from the index where FIELD=VALUE (wildcards * and ?), or FIELD<VALUE and so on. May be given more than once')
+    p.add_option('--sigma', action="store", type='float', dest="sigma",
+                 help='Sigma edit the Z-axis forces with this threshold before finding the weight')
+    p.add_option('--sigma-window', action="store", type='int', dest="sigma_window",
+                 help='Number of frames in a rolling window for the sigma edit')
+    p.add_option('--store-file', action='store', type='string', dest='store_file',
+                 help='Keep the results for each file in this file (default: %s in the cache directory)' % RESULTS_FILE)
     p.add_option('-t', action="store", dest="t_range", nargs=4, default=(None,None,None,None),type='float',
                  help='Set the time range for the file using the start and end time and also include the force range')
+    p.add_option('--timings', action="store_true", dest="timings", default=False,
+                 help='Print the time and memory used in each stage for each file and the batch')
+    p.add_option('--timings-json', action='store', type='string', dest='timings_json',
+                 help='Save the time and memory used in each stage to this JSON file')
     p.add_option('-w', action="store_true", dest="weight", default = False,
                  help='Determine the weight of a player from the given range of data')
+    p.add_option('--windows', action='store', type='string', dest='windows',
+                 help='Find the impulse in each frame window given as "start:end,start:end"')
+    p.add_option('--windows-file', action='store', type='string', dest='windows_file',
+                 help='File with a start and end frame for each window to find the impulse in')
     p.add_option('-x', action="store_true", dest="x_plot", default=False,
                  help='Plot force in x direction for both plates')
     p.add_option('-y', action="store_true", dest="y_plot", default=False,
@@ -739,11 +3234,45 @@ if __name__ == '__main__':
             p.print_help()
             sys.exit() 
     
+    #--- Follow a file or directory that is being written and then stop
+    #    Any axes chosen for the plates are plotted as the data comes in
+    if options.follow:
+        plot_keys = []
+        for plate, do_plate in (('1', plate_1), ('2', plate_2)):
+            for axis, do_axis in (('X', options.x_plot), ('Y', options.y_plot), ('Z', options.z_plot)):
+                if do_plate and do_axis:
+                    plot_keys.append('p%s_%s' % (plate, axis))
+        follow_kwargs = {'fps': options.fps,
+                         'window': options.follow_window,
+                         'calibration_file': options.calibration_file,
+                         'profile': options.profile,
+                         'show_weight': options.weight,
+                         'plot_keys': plot_keys}
+        
+        if options.weight:
+            weight_header()
+        else:
+            impulse_header()
+        try:
+            if options.filename:
+                followFile(options.filename, **follow_kwargs)
+            else:
+                followDirectory(options.dirName, **follow_kwargs)
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+    
     #--- If a user specifies a filename then only parse that file
     file_list = []
     if options.filename and os.path.isfile(options.filename):
         file_list.append(options.filename)
     
+    #--- Select files from the index of the directory and everything
+    #    under it, bringing the index up to date first
+    elif options.index or options.select:
+        with timers.stage('index'):
+            file_list = indexedFiles(options.dirName, options.select, options.index_file)
+    
     #--- If no filename is specified then look through the given directory
     #    The default is to look in the current directory if none is given
     elif os.path.isdir(options.dirName):
@@ -758,20 +3287,11 @@ if __name__ == '__main__':
     file_list = list(set(file_list))
     file_list.sort()
     
-    #--- Set up a regular expression for the file name
-    #    (ie three letters and number, an underscore, three numbers, file ext)
-    #    Example: GR1_020.KDA 
-    rexp_filename = re.compile(r'(?P<filename>[A-Z0-9]{3}_[0-9]{3})\.[KDA|kda]')
-    
-    #--- Check each item in the list to see if it matches the naming convention
-    for file in file_list:
-        rmatch_filename = rexp_filename.match(os.path.basename(file))
-        
-        #--- If there is no match then remove file
-        #if rmatch_filename:
-        #    print rmatch_filename.group('filename')
-        if not rmatch_filename:
-            file_list.remove(file)
+    #--- Only keep the files that match the naming convention
+    #    A new list is made, since removing files from the list while
+    #    going through it would skip the file after each one removed
+    file_list = [file for file in file_list
+                 if rexp_filename.match(os.path.basename(file))]
     
     #--- Grab the frame numbers
     align_list = []
@@ -779,41 +3299,314 @@ if __name__ == '__main__':
         align_list = options.align.split(',')
     
     #--- Make sure that there is one value for every file
+    #    Files without a value are aligned on their first contact
     while len(align_list) < len(file_list):
-        align_list.append('0')
+        align_list.append(None)
 
+    #--- Check the sigma edit threshold before parsing anything
+    #    The sigma edit needs all of the data, so it cannot be streamed
+    if options.sigma is not None:
+        checkSigma(options.sigma)
+        if options.stream:
+            print "\nThe sigma edit cannot be used when streaming files"
+            sys.exit()
+    
+    #--- The power spectrum and resampling need all of the data
+    if options.spectrum and options.stream:
+        print "\nThe power spectrum cannot be found when streaming files"
+        sys.exit()
+    if options.rate and options.stream:
+        print "\nFiles cannot be resampled when streaming them"
+        sys.exit()
+    
+    #--- Streaming only keeps running sums, which are double precision
+    if options.dtype != DTYPES[0] and options.stream:
+        print "\nThe --dtype option cannot be used when streaming files"
+        sys.exit()
+    
+    #--- Filtering runs backwards over the data, so it cannot be streamed
+    if (options.lowpass is not None or options.notch is not None) and options.stream:
+        print "\nThe forces cannot be filtered when streaming files"
+        sys.exit()
+    
+    #--- Read the impulse windows before parsing anything
+    impulse_windows = None
+    if options.windows or options.windows_file:
+        impulse_windows = readWindows(options.windows, options.windows_file)
+        if options.stream:
+            print "\nImpulse windows cannot be used when streaming files"
+            sys.exit()
+    
+    #--- Pick the format of the results from the output file if not given
+    output_format = options.format
+    if output_format is None:
+        output_format = 'text'
+        if options.output:
+            ext = os.path.splitext(options.output)[1].lower()
+            output_format = {'.csv': 'csv',
+                             '.json': 'json',
+                             '.jsonl': 'json',
+                             '.npy': 'npy'}.get(ext, 'text')
+    if output_format == 'npy' and not options.output:
+        print "\nNumPy results must be written to a file given with -o"
+        sys.exit()
+    
+    #--- Do not use the cache if it has been turned off
+    cache_dir = options.cache_dir
+    if options.no_cache:
+        cache_dir = None
+    
+    #--- Plots drawn without a display are always saved
+    if options.headless:
+        options.save_plot = True
+    
     #--- Do not save any plots if looking at weight
     if options.weight:
         options.save_plot = False
+        options.headless = False
     
     #--- Create a dictionary that holds the file name and time data
     file_dict = {}
     
+    #--- Only keep the data for each file if it is going to be plotted
+    #    or if the results are going to be found for all files at once
+    #    Without a display each file's plates are drawn as it is parsed
+    keep_data = options.collect or options.batch or options.spectrum or options.rate
+    keep_data = keep_data or (len(file_list) == 1 and not options.headless)
+    plot_kwargs = None
+    if options.headless and not options.collect:
+        plot_kwargs = {'inspect': options.inspect,
+                       't_range': options.t_range,
+                       'plate_1': plate_1,
+                       'plate_2': plate_2,
+                       'x_plot': options.x_plot,
+                       'y_plot': options.y_plot,
+                       'z_plot': options.z_plot,
+                       'cop_plot': options.cop_plot,
+                       'decimate': options.decimate}
+    
+    #--- Build the list of files to process with the parsing options
+    #    Streaming only gives the summary so nothing can be plotted
+    if options.stream:
+        parse = streamFile
+        parse_kwargs = {'range': options.range,
+                        'chunk_rows': options.chunk_rows,
+                        'calibration_file': options.calibration_file,
+                        'profile': options.profile}
+        keep_data = False
+        plot_kwargs = None
+        options.collect = False
+        options.batch = False
+    else:
+        parse = parseFile
+        parse_kwargs = {'range': options.range,
+                        'cache_dir': cache_dir,
+                        'rebuild_cache': options.rebuild_cache,
+                        'cache_size': options.cache_size,
+                        'cache_hash': options.cache_hash,
+                        'calibration_file': options.calibration_file,
+                        'profile': options.profile,
+                        'sigma': options.sigma,
+                        'sigma_window': options.sigma_window,
+                        'contact_on': options.contact_on,
+                        'contact_off': options.contact_off,
+                        'contact_min': options.contact_min,
+                        'windows': impulse_windows,
+                        'lowpass': options.lowpass,
+                        'notch': options.notch,
+                        'dtype': options.dtype,
+                        'cop_force': options.cop_force}
+    
+    #--- Time each stage if asked to, profiling the whole run if asked to
+    timed = options.timings or bool(options.timings_json)
+    timers.enabled = timed
+    profiler = None
+    if options.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    #--- Scan and parse the files in a pool of processes if more than one
+    #    job is requested.  The results come back in the same order as the list.
+    pool = None
+    jobs = options.jobs
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(file_list) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(file_list)))
+        imap = pool.imap
+    else:
+        imap = itertools.imap
+    
+    #--- Use the stored results of files that have not changed since they
+    #    were last processed with the same options.  Results can only be
+    #    used again when the data for each file is not needed.
+    store = None
+    stored = {}
+    store_keys = {}
+    if options.store and cache_dir is not None and not keep_data and plot_kwargs is None:
+        with timers.stage('store'):
+            store = ResultsStore(options.store_file or os.path.join(cache_dir, RESULTS_FILE))
+            
+            #--- Files that cannot be keyed, for example because of a bad
+            #    header or calibration file, are left for processFile to
+            #    report like any other file that cannot be parsed
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                for file in file_list:
+                    try:
+                        store_keys[file] = store.key(file, parse, parse_kwargs)
+                    except (Exception, SystemExit):
+                        continue
+                    data_dict = None
+                    if not options.rebuild_cache:
+                        data_dict = store.load(store_keys[file], file)
+                    if data_dict is not None:
+                        stored[file] = data_dict
+            finally:
+                sys.stdout = stdout
+    
+    #--- Count the records in each file before parsing any of them
+    #    Files that cannot be used are left out and reported together.
+    #    Files with stored results were already found to be good.
+    if options.scan:
+        with timers.stage('scan'):
+            scanned = imap(scanFile, [(file, options.range) for file in file_list
+                                      if file not in stored])
+            manifest = [(file, None, None) if file in stored else scanned.next()
+                        for file in file_list]
+        
+        valid = [problem is None for file, records, problem in manifest]
+        file_list = [file for file, ok in zip(file_list, valid) if ok]
+        align_list = [align for align, ok in zip(align_list, valid) if ok]
+        
+        if not all(valid):
+            print >> sys.stderr, "\nSkipping %d of %d files:" % (valid.count(False), len(valid))
+            for file, records, problem in manifest:
+                if problem is not None:
+                    print >> sys.stderr, "  %s" % (file)
+                    print >> sys.stderr, "\t%s" % (problem.replace('\n', '\n\t'))
+        
+        if options.manifest:
+            out = open(options.manifest, 'w')
+            json.dump([{'filename': file, 'records': records,
+                        'valid': problem is None, 'problem': problem}
+                       for file, records, problem in manifest],
+                      out, indent = 1)
+            out.close()
+    
+    tasks = [(parse, file, parse_kwargs, keep_data, plot_kwargs, timed)
+             for file in file_list if file not in stored]
+    results = mergeResults(file_list, stored, imap(processFile, tasks))
+    
+    #--- Start the table of results before any of the files
+    #    Streamed files have no center of pressure, so those columns are
+    #    left out rather than written empty for every file
+    table = None
+    if file_list:
+        fields = SUMMARY_FIELDS
+        if options.stream:
+            fields = [field for field in SUMMARY_FIELDS if field not in COP_FIELDS]
+        table = SummaryTable(options.output, output_format,
+                             show_weight = options.weight,
+                             name_size = max([len(file) for file in file_list]),
+                             fields = fields)
+    
     #--- Keep an index of the files and cycle through the list
     count = 0
-    for file in file_list:
+    for file, data_dict, error in results:
         
-        #--- Parse the data into a dictionary
-        file_dict[file] = parseFile(file, range = options.range)
-        file_dict[file]['align'] = float(align_list[count])
+        #--- Report any file that could not be parsed and move on
+        if error:
+            print >> sys.stderr, "\nUnable to process %s:" % (file)
+            print >> sys.stderr, "\t%s" % (error.replace('\n', '\n\t'))
+            count += 1
+            continue
         
-        #--- Print weight or impulse data for the file
-        if options.weight:
-            #--- Print header on first time through
-            if count == 0:
-                weight_header()
-            weight(file_dict[file])
-        else:
-            #--- Print header on first time through
-            if count == 0:
-                impulse_header()
-            impulse(file_dict[file])
+        #--- Keep the results of each file that was processed
+        if store and file not in stored and file in store_keys:
+            with timers.stage('store'):
+                store.save(store_keys[file], data_dict)
+        
+        #--- Put the data into the dictionary with its alignment value
+        #    Use the first contact if no value was given for the file
+        file_dict[file] = data_dict
+        align = align_list[count]
+        if align is None:
+            align = data_dict.get('contact_frame') or 0
+        file_dict[file]['align'] = float(align)
+        
+        #--- Add the weight or impulse data for the file to the results
+        if not options.batch:
+            table.append(file_dict[file])
         
         #--- Increase the counter to get the next alignment value
         count += 1
     
+    if pool:
+        pool.close()
+        pool.join()
+    
+    #--- Bring every trial onto the same rate before comparing them
+    if options.rate:
+        trials = [file_dict[file] for file in file_list if file in file_dict]
+        with timers.stage('resample'):
+            trials = resampleTrials(trials, options.rate, options.resample)
+        for trial in trials:
+            file_dict[trial['filename']] = trial
+    
+    #--- Find the weight or impulse data for all the files at once
+    #    The header information comes from each trial
+    if options.batch and file_dict:
+        trials = [file_dict[file] for file in file_list if file in file_dict]
+        summary = batchSummary(trials, options.sigma, options.sigma_window)
+        for trial, row in zip(trials, summary):
+            data_dict = trial.summary()
+            data_dict.update(zip(summary.dtype.names, row))
+            table.append(data_dict)
+    
+    if table:
+        table.close()
+    if store:
+        store.close()
+    
+    #--- Print the impulse in each window of each file
+    if impulse_windows is not None:
+        windows_header()
+        for file in file_list:
+            if file in file_dict:
+                windows(file_dict[file])
+    
+    #--- Print the contacts found in each file
+    #    These are not found when streaming since the data is not kept
+    if options.events and not options.stream:
+        contacts_header()
+        for file in file_list:
+            if file in file_dict:
+                contacts(file_dict[file])
+    
+    #--- Find the power spectrum of every file at once and print the
+    #    dominant frequencies, plotting any chosen plates and axes
+    if options.spectrum:
+        trials = [file_dict[file] for file in file_list if file in file_dict]
+        with timers.stage('spectrum'):
+            powerSpectra(trials, options.spectrum_segment)
+        spectrum_header()
+        for trial in trials:
+            spectrum(trial)
+        plot_spectrum(file_dict = file_dict,
+                      plate_1 = plate_1,
+                      plate_2 = plate_2,
+                      x_plot = options.x_plot,
+                      y_plot = options.y_plot,
+                      z_plot = options.z_plot,
+                      save_plot = options.save_plot,
+                      headless = options.headless,
+                      jobs = options.jobs,
+                      decimate = options.decimate)
+    
     #--- If only looking at one file use this
-    if len(file_list) == 1 and not options.collect:
+    if len(file_list) == 1 and keep_data and file_list[0] in file_dict and not options.collect:
         
         plot_plates(file_dict[file_list[0]],
                     inspect = options.inspect,
@@ -823,7 +3616,9 @@ if __name__ == '__main__':
                     x_plot = options.x_plot,
                     y_plot = options.y_plot,
                     z_plot = options.z_plot,
-                    save_plot = options.save_plot)
+                    cop_plot = options.cop_plot,
+                    save_plot = options.save_plot,
+                    decimate = options.decimate)
     
     #--- Plot the data
     elif options.collect:
@@ -837,14 +3632,54 @@ if __name__ == '__main__':
                         x_plot = options.x_plot,
                         y_plot = options.y_plot,
                         z_plot = options.z_plot,
-                        save_plot = options.save_plot)
+                        cop_plot = options.cop_plot,
+                        save_plot = options.save_plot,
+                        headless = options.headless,
+                        jobs = options.jobs,
+                        decimate = options.decimate)
+    
+    #--- Bring the cache back under its size once the batch is done, as
+    #    the cumulative impulse and resampled forces are saved without a
+    #    check.  Entries used by this run are kept.
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        with timers.stage('cache write'):
+            pruneCache(cache_dir, options.cache_size, since = cache_run_start)
+    
+    #--- Print the time used in each stage of each file and in total
+    #    The plots drawn here count towards the total for the batch
+    if timed:
+        file_timings = {}
+        batch_timings = {}
+        for file in file_list:
+            if file in file_dict and 'timings' in file_dict[file]:
+                file_timings[file] = file_dict[file]['timings']
+                addTimings(batch_timings, file_timings[file])
+        addTimings(batch_timings, timers.reset())
+        
+        if options.timings:
+            timings_header()
+            for file in file_list:
+                if file in file_timings:
+                    timings(os.path.basename(file), file_timings[file])
+            timings('All files', batch_timings)
+        
+        if options.timings_json:
+            out = open(options.timings_json, 'w')
+            json.dump({'files': file_timings, 'total': batch_timings},
+                      out, indent = 1, sort_keys = True)
+            out.close()
+    
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(options.cprofile)
     
     #--- Finally, show the plots unless calculating weight
     #    Plot 1 or 2 (or both) must be chose
     #    You must not be doing weight calculations
     #    Finally, if any axis is chosen then plot
-    do_plot = (plate_1 or plate_2) and not options.weight
-    do_plot = do_plot and (options.x_plot or options.y_plot or options.z_plot)
-    if do_plot and (options.collect or len(file_list) == 1):
+    do_plot = (plate_1 or plate_2) and keep_data and not options.weight
+    do_plot = do_plot and not options.headless
+    do_plot = do_plot and (options.x_plot or options.y_plot or options.z_plot or options.cop_plot)
+    if do_plot and (options.collect or options.spectrum or len(file_list) == 1):
         pylab.show()
     
\ No newline at end of file
@@ -0,0 +1,281 @@
+#! /opt/local/bin/python
+
+"""
+    Tests for the results written by kda_reader.py
+    
+    Run with: python -m unittest test_kda_reader
+"""
+
+#--- Import the necessary libraries for this file
+import json     # used for reading the results back strictly
+import os       # used for building file names
+import shutil   # used for removing the test directory
+import subprocess # used for running the reader as a user would
+import sys      # used for finding the Python running the tests
+import tempfile # used for a directory to write the test files in
+import unittest # used for running the tests
+
+import numpy
+
+import kda_benchmark
+import kda_reader
+
+#--- Location of the reader that is run for each test
+READER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kda_reader.py')
+
+#--- A function to fail on NaN or Infinity, which are not valid JSON
+def rejectConstant(name): # The constant that was found
+    raise ValueError(name)
+
+#--- A function to write a KDA file with nothing on plate 2
+#    Plate 1 has a constant load spread over its Z-axis cells
+def writeKDA(filename,   # Name of the file to write
+             rows = 1200): # Number of records in the file
+    data = numpy.zeros((rows, kda_reader.NUM_COLUMNS))
+    data[:,4:8] = 700.0 / 4.0 / kda_reader.Zc1
+    data[:,4] *= 1.2
+    
+    file = open(filename, 'wb')
+    file.write('GR1 Test\n')
+    file.write('6/26/2010 -- 3:45 PM\n')
+    file.write('Scan Rate = 1200\n')
+    file.write('Total Scans = %d\n' % rows)
+    file.write('Digital Trigger Off\n')
+    file.write('X1,X2,Y1,Y2,Z1,Z2,Z3,Z4,X1,X2,Y1,Y2,Z1,Z2,Z3,Z4\n')
+    numpy.savetxt(file, data, fmt = '%.6f', delimiter = ',')
+    file.close()
+
+class SummaryOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'GR1_000.KDA')
+        writeKDA(self.filename)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def run_reader(self, output, *args): # Results file and other options
+        env = dict(os.environ, MPLBACKEND = 'Agg')
+        subprocess.check_call([sys.executable, READER, '-f', self.filename,
+                               '--no-cache', '-o', output] + list(args),
+                              env = env)
+        file = open(output, 'r')
+        lines = file.read().splitlines()
+        file.close()
+        return lines
+    
+    def test_json_unloaded_plate(self):
+        """A plate with no load gives null for its center of pressure"""
+        output = os.path.join(self.dir, 'summary.json')
+        lines = self.run_reader(output, '--format', 'json')
+        self.assertEqual(len(lines), 1)
+        row = json.loads(lines[0], parse_constant = rejectConstant)
+        self.assertIsNone(row['p2_COP_X_mean'])
+        self.assertIsNone(row['p2_COP_Y_mean'])
+        self.assertGreater(row['p1_COP_X_mean'], 0.0)
+        self.assertGreater(row['p1_COP_Y_mean'], 0.0)
+        self.assertAlmostEqual(row['p2_weight'], 0.0)
+    
+    def test_json_stream(self):
+        """Streamed files leave out the center of pressure columns"""
+        output = os.path.join(self.dir, 'summary.json')
+        lines = self.run_reader(output, '--format', 'json', '--stream')
+        row = json.loads(lines[0], parse_constant = rejectConstant)
+        for channel in kda_reader.COP_CHANNELS:
+            self.assertNotIn('%s_mean' % channel, row)
+        self.assertIn('p1_weight', row)
+    
+    def test_csv_unloaded_plate(self):
+        """A plate with no load gives empty cells instead of nan"""
+        output = os.path.join(self.dir, 'summary.csv')
+        names, values = [line.split(',') for line in self.run_reader(output, '--format', 'csv')]
+        row = dict(zip(names, values))
+        self.assertEqual(row['p2_COP_X_mean'], '')
+        self.assertNotIn('nan', values)
+
+class CacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        kda_reader.cache_sizes.clear()
+        kda_reader.full_caches.clear()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_run_entries_kept(self):
+        """Entries used by the run are not evicted to make room for more"""
+        names = [os.path.join(self.dir, 'GR1_%03d.KDA' % i) for i in xrange(4)]
+        for name in names:
+            writeKDA(name, rows = 2000)
+        size = 2000*kda_reader.NUM_COLUMNS*8 / (1024.0 * 1024.0)
+        for name in names:
+            kda_reader.loadKDA(name, cache_dir = self.cache_dir, cache_size = 2.5*size)
+        cached = [name for name in names
+                  if kda_reader.readCache(name, self.cache_dir) is not None]
+        self.assertEqual(cached, names[:2])
+        self.assertIn(self.cache_dir, kda_reader.full_caches)
+
+class StreamTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'GR1_000.KDA')
+        kda_benchmark.writeKDA(self.filename, 5000)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def assertSameResults(self, streamed, parsed): # Results to compare
+        names = ['total_time', 'p1_weight', 'p2_weight']
+        names += ['%s_imp_net' % channel for channel in kda_reader.CHANNELS]
+        self.assertTrue(numpy.allclose([streamed[name] for name in names],
+                                       [parsed[name] for name in names],
+                                       rtol = 1e-10, atol = 1e-9))
+    
+    def test_stream_matches_parse(self):
+        """Streaming in small chunks gives the same results as parsing"""
+        parsed = kda_reader.parseFile(self.filename).summary()
+        self.assertTrue(len(parsed['p1_contacts']))
+        for chunk_rows in (97, 1000, 5000):
+            self.assertSameResults(kda_reader.streamFile(self.filename, chunk_rows = chunk_rows),
+                                   parsed)
+    
+    def test_stream_matches_parse_range(self):
+        """A frame range that starts and ends inside chunks is streamed exactly"""
+        range = (1234, 4321)
+        parsed = kda_reader.parseFile(self.filename, range = range).summary()
+        self.assertSameResults(kda_reader.streamFile(self.filename, range = range, chunk_rows = 500),
+                               parsed)
+
+#--- A sigma edit that finds the stats of the kept points from scratch on
+#    every pass, one row at a time, to check sigmaEdit against
+def naiveSigmaEdit(x, sigmaThresh, window = None): # Rows, threshold, rolling window
+    x = numpy.atleast_2d(x)
+    keep = numpy.ones(x.shape, dtype=bool)
+    while True:
+        removed = numpy.zeros(x.shape, dtype=bool)
+        for row in xrange(len(x)):
+            if window is None:
+                values = x[row][keep[row]]
+                removed[row] = keep[row] & (abs(x[row] - values.mean()) > sigmaThresh*values.std())
+                continue
+            for index in xrange(x.shape[-1]):
+                half = window // 2
+                lower, upper = max(index - half, 0), index + half + 1
+                values = x[row, lower:upper][keep[row, lower:upper]]
+                if keep[row, index] and len(values):
+                    removed[row, index] = abs(x[row, index] - values.mean()) > sigmaThresh*values.std()
+        if not removed.any():
+            return ~keep
+        keep &= ~removed
+
+class NumericsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'GR1_000.KDA')
+        kda_benchmark.writeKDA(self.filename, 3000)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def spiked(self, samples): # Number of samples in each row
+        random = numpy.random.RandomState(1)
+        z = kda_reader.parseFile(self.filename).forces[[2,5],:samples].copy()
+        spikes = random.randint(0, samples, 20)
+        z[:,spikes] += random.normal(0, 200.0, (2, 20))
+        return z
+    
+    def test_sigma_edit_matches_naive(self):
+        """The running sums remove the same points as finding the stats again"""
+        z = self.spiked(3000)
+        for sigma in (2.0, 3.0):
+            edited = kda_reader.sigmaEdit(z, sigma)
+            self.assertTrue(numpy.array_equal(numpy.ma.getmaskarray(edited), naiveSigmaEdit(z, sigma)))
+    
+    def test_sigma_edit_rolling_matches_naive(self):
+        """The rolling window sums remove the same points as each window's stats"""
+        z = self.spiked(400)
+        edited = kda_reader.sigmaEditRolling(z, 3.0, 51)
+        self.assertTrue(numpy.array_equal(numpy.ma.getmaskarray(edited), naiveSigmaEdit(z, 3.0, 51)))
+    
+    def test_impulse_windows_match_range(self):
+        """Each window gives the same impulse as parsing just that range"""
+        trial = kda_reader.parseFile(self.filename)
+        windows = [(0, 2999), (10, 11), (100, 1800), (1500, 2999), (2200, 2201 + 500)]
+        impulses = kda_reader.impulseWindows(trial, windows)
+        for (start, end), impulse in zip(windows, impulses):
+            parsed = kda_reader.parseFile(self.filename, range = (start, end))
+            expected = [parsed['%s_imp_net' % channel] for channel in kda_reader.CHANNELS]
+            self.assertTrue(numpy.allclose(impulse, expected, rtol = 1e-9, atol = 1e-9))
+
+class ScanTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'GR1_000.KDA')
+        kda_benchmark.writeKDA(self.filename, 2000)
+        
+        #--- Put blank lines inside the body of the file
+        file = open(self.filename, 'rb')
+        lines = file.read().split('\n')
+        file.close()
+        lines.insert(500, '')
+        lines.insert(1500, '\r')
+        file = open(self.filename, 'wb')
+        file.write('\n'.join(lines))
+        file.close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_blank_lines_counted(self):
+        """Blank lines are not counted as records, the same as when decoding"""
+        records = kda_reader.countRecords(self.filename, block_size = 4096)[-1]
+        self.assertEqual(records, 2000)
+        self.assertEqual(len(kda_reader.readKDA(self.filename)[-1]), records)
+    
+    def test_blank_lines_processed(self):
+        """A file with blank lines in its body passes the scan and is processed"""
+        output = os.path.join(self.dir, 'summary.json')
+        env = dict(os.environ, MPLBACKEND = 'Agg')
+        subprocess.check_call([sys.executable, READER, '-d', self.dir, '--no-cache',
+                               '-o', output, '--format', 'json'], env = env)
+        file = open(output, 'r')
+        lines = file.read().splitlines()
+        file.close()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['total_scans'], 2000)
+
+class StoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.dir, 'data')
+        os.makedirs(self.data_dir)
+        for name in ('GR1_000.KDA', 'GR1_001.KDA'):
+            writeKDA(os.path.join(self.data_dir, name))
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_bad_calibration_reported(self):
+        """A calibration file that cannot be read fails its files, not the batch"""
+        file = open(os.path.join(self.data_dir, kda_reader.CALIBRATION_FILE), 'w')
+        file.write('Zc1 = 1000.0\n')
+        file.close()
+        env = dict(os.environ, MPLBACKEND = 'Agg')
+        process = subprocess.Popen([sys.executable, READER, '-d', self.data_dir,
+                                    '--cache-dir', os.path.join(self.dir, 'cache')],
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                   env = env)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        self.assertIn('Unable to process', stderr)
+        self.assertIn('MissingSectionHeaderError', stderr)
+
+if __name__ == '__main__':
+    unittest.main()